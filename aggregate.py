@@ -0,0 +1,185 @@
+import heapq
+import os
+import tempfile
+from typing import Iterator, TextIO
+
+import chess
+import chess.pgn
+import chess.polyglot
+import click
+import numpy as np
+
+from binary_dataset import ShardWriter, pack_castling, unpack_board
+from generate_dataset import MainlineVisitor
+from pgn_index import GameIndex
+from pgn_io import open_pgn
+from to_matrix import PositionKey, board_bitboards, code_to_move, key_board
+
+RUN_DTYPE = np.dtype([("key", "<u8"), ("move", "<u2"), ("count", "<u4")])
+RUN_POSITION_DTYPE = np.dtype(
+    [
+        ("key", "<u8"),
+        ("bitboards", "<u8", (12,)),
+        ("turn", "u1"),
+        ("castling", "u1"),
+        ("ep_square", "i1"),
+    ]
+)
+# Rough in-memory cost of a dict entry of each kind, used for the budget
+COUNT_ENTRY_BYTES = 160
+POSITION_ENTRY_BYTES = 360
+
+
+def pack_position(board: chess.Board) -> tuple[list[int], bool, int, int]:
+    return (
+        board_bitboards(board).tolist(),
+        board.turn,
+        pack_castling(board),
+        -1 if board.ep_square is None else board.ep_square,
+    )
+
+
+def load_offset_packed(
+    pgn: TextIO, offset: int
+) -> list[tuple[int, int, tuple[list[int], bool, int, int]]]:
+    # (Zobrist key, move code, packed position) of every mainline move
+    pgn.seek(offset)
+    game = chess.pgn.read_game(pgn, Visitor=MainlineVisitor)
+    if not game or game.errors:
+        return []
+    # Keyed and packed once per distinct position of the game
+    keys: dict[PositionKey, int] = {}
+    positions: dict[PositionKey, tuple[list[int], bool, int, int]] = {}
+    for key, _code in game.positions:
+        if key not in keys:
+            board = key_board(key)
+            keys[key] = chess.polyglot.zobrist_hash(board)
+            positions[key] = pack_position(board)
+    return [(keys[key], code, positions[key]) for key, code in game.positions]
+
+
+def iter_run(path: str, chunk_size: int = 1 << 16) -> Iterator:
+    run = np.load(path, mmap_mode="r")
+    for start in range(0, len(run), chunk_size):
+        yield from run[start : start + chunk_size]
+
+
+class PositionAggregator:
+    # Counts (position key, move code) pairs. Whenever the estimated memory
+    # use exceeds the budget the counts are written to disk as a sorted run;
+    # merged() combines all runs with a k-way merge.
+    def __init__(self, directory: str, memory_budget: int = 1 << 30):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.counts: dict[tuple[int, int], int] = {}
+        self.positions: dict[int, tuple[list[int], bool, int, int]] = {}
+        self.runs: list[tuple[str, str]] = []
+
+    def memory_estimate(self) -> int:
+        return (
+            len(self.counts) * COUNT_ENTRY_BYTES
+            + len(self.positions) * POSITION_ENTRY_BYTES
+        )
+
+    def add(self, key: int, move: int, position: tuple[list[int], bool, int, int]):
+        self.counts[(key, move)] = self.counts.get((key, move), 0) + 1
+        if key not in self.positions:
+            self.positions[key] = position
+        if self.memory_estimate() > self.memory_budget:
+            self.spill()
+
+    def add_game(self, moves: list[tuple[int, int, tuple[list[int], bool, int, int]]]):
+        for key, move, position in moves:
+            self.add(key, move, position)
+
+    def spill(self):
+        if not self.counts:
+            return
+        path = os.path.join(self.directory, f"run_{len(self.runs):05d}")
+        counts = np.array(
+            sorted((key, move, count) for (key, move), count in self.counts.items()),
+            dtype=RUN_DTYPE,
+        )
+        positions = np.array(
+            sorted((key, *position) for key, position in self.positions.items()),
+            dtype=RUN_POSITION_DTYPE,
+        )
+        np.save(f"{path}.counts.npy", counts)
+        np.save(f"{path}.positions.npy", positions)
+        self.runs.append((f"{path}.counts.npy", f"{path}.positions.npy"))
+        self.counts.clear()
+        self.positions.clear()
+
+    def merged(self) -> Iterator[tuple[np.void, dict[int, int]]]:
+        # Yields every position once, in key order, with its summed counts
+        self.spill()
+        counts = heapq.merge(
+            *(iter_run(counts_path) for counts_path, _ in self.runs),
+            key=lambda record: (int(record["key"]), int(record["move"])),
+        )
+        positions = heapq.merge(
+            *(iter_run(positions_path) for _, positions_path in self.runs),
+            key=lambda record: int(record["key"]),
+        )
+        position = None
+        key = None
+        move_counts: dict[int, int] = {}
+        for record in counts:
+            if record["key"] != key:
+                if key is not None:
+                    yield position, move_counts
+                key = record["key"]
+                move_counts = {}
+                position = next(positions)
+                while position["key"] != key:
+                    position = next(positions)
+            move = int(record["move"])
+            move_counts[move] = move_counts.get(move, 0) + int(record["count"])
+        if key is not None:
+            yield position, move_counts
+
+
+def write_dataset(
+    aggregator: PositionAggregator, prefix: str, shard_size: int = 50000
+) -> int:
+    writer = ShardWriter(prefix, shard_size)
+    for position, move_counts in aggregator.merged():
+        writer.add(
+            unpack_board(position),
+            {code_to_move(code): count for code, count in move_counts.items()},
+        )
+    writer.close()
+    return writer.n_shards
+
+
+@click.command()
+@click.argument("pgn_path")
+@click.argument("prefix")
+@click.option("--memory-mb", default=1024, help="Budget before spilling a run")
+@click.option("--min-elo", default=None, type=int)
+@click.option("--max-elo", default=None, type=int)
+@click.option("--shard-size", default=50000)
+def main(
+    pgn_path: str,
+    prefix: str,
+    memory_mb: int,
+    min_elo: int | None,
+    max_elo: int | None,
+    shard_size: int,
+):
+    offsets = GameIndex.open(pgn_path).select(min_elo=min_elo, max_elo=max_elo)
+    with tempfile.TemporaryDirectory() as directory, open_pgn(pgn_path) as pgn:
+        aggregator = PositionAggregator(directory, memory_mb << 20)
+        for game_id, offset in enumerate(offsets.tolist()):
+            aggregator.add_game(load_offset_packed(pgn, offset))
+            if not game_id % 1000:
+                print(
+                    f"{game_id}/{len(offsets)} games, {len(aggregator.runs)} runs",
+                    end="\r",
+                )
+        n_shards = write_dataset(aggregator, prefix, shard_size)
+    print(f"Aggregated {len(offsets)} games into {n_shards} shards")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,112 +1,385 @@
 from __future__ import annotations
-from dataclasses import dataclass
-import math
+import multiprocessing
+from multiprocessing.connection import Connection
+import threading
+import time
 from typing import Callable
 
 import chess
+import numpy as np
+import torch
 
+from search_stats import SearchStats, attach, cache_counters
+from search_tree import SearchTree, predict_batch
+from to_matrix import code_to_move
 
-@dataclass
-class Scenario:
-    board: chess.Board
-    move: chess.Move | None
-    score: float
-    predict: Callable[[chess.Board], dict[chess.Move, float]]
-    explored_children: list[Scenario] | None = None
-    depth_coef: float = 1.25
-    rewarded_move_number: float = 24
-    score_override_coef: float = 0.1
-
-    def expand(self) -> bool:
-        if self.explored_children is not None:
-            child_to_expand = max(
-                self.explored_children,
-                key=lambda child: child.expansion_probability(),
-            )
-            return child_to_expand.expand()
 
-        # if trying to expand a game over scenario, return False
-        if self.board.is_game_over():
-            return False
+def amplify(
+    board,
+    predict: Callable[[chess.Board], dict[chess.Move, float]],
+    n_scenarios: int,
+    batch_size: int = 1,
+) -> dict[chess.Move, float]:
+    tree = SearchTree(board, predict)
+    while tree.n_explored() < n_scenarios and tree.expand_batch(batch_size):
+        pass
+    return tree.root_values()
 
-        self.explored_children = []
-        for move, score in self.predict(self.board).items():
-            board = self.board.copy()
-            board.push(move)
-            self.explored_children.append(
-                Scenario(
-                    board=board,
-                    move=move,
-                    score=score,
-                    predict=self.predict,
-                )
-            )
-        return True
-
-    def expansion_probability(self):
-        # Special treatment for game over scenarios
-        if self.board.is_game_over():
-            return 0
-        if self.explored_children is None:
-            return self.score
+
+def time_budget(
+    remaining: float,
+    increment: float = 0,
+    moves_to_go: int | None = None,
+    overhead: float = 0.05,
+) -> float:
+    # Spread the remaining clock over the moves still to play, spend most of
+    # the increment and never plan to use more than half of what is left
+    budget = remaining / (moves_to_go or 30) + increment * 0.75
+    return max(min(budget, remaining / 2) - overhead, 0)
+
+
+class Searcher:
+    # Keeps the search tree between calls, so the subtree under the moves
+    # played since the last call is searched further instead of rebuilt
+    def __init__(
+        self,
+        predict: Callable[[chess.Board], dict[chess.Move, float]],
+        n_scenarios: int,
+        batch_size: int = 1,
+        dominance_margin: float = 0.2,
+        stopped: threading.Event | None = None,
+        collect_stats: bool = False,
+    ):
+        self.predict = predict
+        self.n_scenarios = n_scenarios
+        self.batch_size = batch_size
+        self.dominance_margin = dominance_margin
+        self.tree: SearchTree | None = None
+        # A search clears it when it starts and stop() only sets it while a
+        # search runs, so a stop between searches can't end the next one. An
+        # event passed in is shared with other searchers and cleared by its
+        # owner.
+        self.stopped = stopped or threading.Event()
+        self.owns_stopped = stopped is None
+        self.searching = False
+        self.searching_lock = threading.Lock()
+        self.explored = 0
+        # The SearchStats of the last search when collect_stats is set
+        self.collect_stats = collect_stats
+        self.stats: SearchStats | None = None
+
+    def __call__(self, board: chess.Board) -> dict[chess.Move, float]:
+        return self.search(board, nodes=self.n_scenarios)
+
+    def tree_for(self, board: chess.Board) -> SearchTree:
+        if self.tree is None or not self.tree.advance(board):
+            self.tree = SearchTree(board, self.predict)
+        return self.tree
+
+    def search(
+        self,
+        board: chess.Board,
+        deadline: float | None = None,
+        nodes: int | None = None,
+        dominance_margin: float | None = None,
+        stopped: threading.Event | None = None,
+    ) -> dict[chess.Move, float]:
+        # Anytime search: runs until the time.monotonic() deadline, until
+        # `nodes` new leaves were explored, until one move dominates after a
+        # quarter of the time, or until stop() is called from another thread.
+        # `stopped` replaces the searcher's event for this search only.
+        # The root is always expanded so there is a move to return.
+        stopped = stopped or self.stopped
+        with self.searching_lock:
+            if stopped is self.stopped and self.owns_stopped:
+                self.stopped.clear()
+            self.searching = True
+        try:
+            return self.run_search(board, deadline, nodes, dominance_margin, stopped)
+        finally:
+            with self.searching_lock:
+                self.searching = False
+
+    def run_search(
+        self,
+        board: chess.Board,
+        deadline: float | None,
+        nodes: int | None,
+        dominance_margin: float | None,
+        stopped: threading.Event,
+    ) -> dict[chess.Move, float]:
+        start = time.monotonic()
+        tree = self.tree_for(board)
+        explored = tree.n_explored()
+        target = None if nodes is None else explored + nodes
+        stats = SearchStats() if self.collect_stats else None
+        if stats is not None:
+            tree.stats = stats
+            attach(self.predict, stats)
+            counters = cache_counters(self.predict)
+        while not tree.n_children[0] or not self.should_stop(
+            stopped, start, deadline, target, dominance_margin
+        ):
+            if not tree.expand_batch(self.batch_size):
+                break
+            if stats is not None:
+                stats.explored = tree.n_explored() - explored
+        self.explored = tree.n_explored() - explored
+        if stats is not None:
+            tree.stats = None
+            attach(self.predict, None)
+            self.finish_stats(stats, time.monotonic() - start, counters)
+        self.stats = stats
+        return tree.root_values()
+
+    def finish_stats(
+        self, stats: SearchStats, seconds: float, counters: tuple[int, int] | None
+    ):
+        depths = self.tree.leaf_depths()
+        stats.seconds = seconds
+        stats.explored = self.explored
+        stats.max_depth = int(depths.max())
+        stats.mean_depth = float(depths.mean())
+        stats.principal_variation = [
+            move.uci() for move in self.tree.principal_variation()
+        ]
+        if counters is not None:
+            hits, misses = cache_counters(self.predict)
+            stats.cache_hits = hits - counters[0]
+            stats.cache_misses = misses - counters[1]
+
+    def should_stop(
+        self,
+        stopped: threading.Event,
+        start: float,
+        deadline: float | None,
+        target: int | None,
+        dominance_margin: float | None,
+    ) -> bool:
+        if stopped.is_set():
+            return True
+        if target is not None and self.tree.n_explored() >= target:
+            return True
+        if deadline is None:
+            return False
+        now = time.monotonic()
+        if now >= deadline:
+            return True
         return (
-            sum(
-                child.expansion_probability() ** 2 / self.depth_coef
-                for child in self.explored_children
-            )
-            / len(self.explored_children)
-        ) ** 0.5
+            dominance_margin is not None
+            and now - start >= (deadline - start) / 4
+            and self.dominant(dominance_margin)
+        )
 
-    def move_numbers_price(self, moves: int):
-        sigmoid_value = math.exp(moves / self.rewarded_move_number) / (
-            1 + math.exp(moves / self.rewarded_move_number)
+    def dominant(self, margin: float) -> bool:
+        values = self.tree.value[list(self.tree.children(0))]
+        if values.size < 2:
+            return True
+        second, best = np.partition(values, -2)[-2:]
+        return best - second >= margin
+
+    def think(
+        self,
+        board: chess.Board,
+        remaining: float,
+        increment: float = 0,
+        moves_to_go: int | None = None,
+    ) -> dict[chess.Move, float]:
+        deadline = time.monotonic() + time_budget(remaining, increment, moves_to_go)
+        return self.search(
+            board, deadline=deadline, dominance_margin=self.dominance_margin
         )
-        return sigmoid_value * 2 - 1
-
-    def value(self):
-        # Special treatment for game over scenarios
-        if self.board.is_game_over():
-            # We return 1 for a win, 0 for a loss, and 0.5 for a draw
-            return (
-                1
-                if self.board.result() == "1-0"
-                else (0 if self.board.result() == "0-1" else 0.5)
+
+    def stop(self):
+        with self.searching_lock:
+            if self.searching:
+                self.stopped.set()
+
+    def reset(self):
+        self.tree = None
+
+    def close(self):
+        # Nothing to release, like ParallelSearcher.close
+        self.tree = None
+
+    def __enter__(self) -> "Searcher":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NoisyPredictor:
+    # Blends the priors with seeded uniform noise, so that the workers of a
+    # root-parallel search grow different trees
+    def __init__(
+        self,
+        predict: Callable[[chess.Board], dict[chess.Move, float]],
+        noise: float,
+        seed: int,
+    ):
+        self.predict = predict
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    def __call__(self, board: chess.Board) -> dict[chess.Move, float]:
+        return self.predict_many([board])[0]
+
+    def predict_many(self, boards: list[chess.Board]) -> list[dict[chess.Move, float]]:
+        return [
+            {
+                move: score * (1 - self.noise) + self.noise * self.rng.random()
+                for move, score in prediction.items()
+            }
+            for prediction in predict_batch(self.predict, boards)
+        ]
+
+
+def search_worker(
+    connection: Connection,
+    predict: Callable[[chess.Board], dict[chess.Move, float]],
+    batch_size: int,
+    stopped: threading.Event,
+    threads: int,
+    collect_stats: bool = False,
+):
+    torch.set_num_threads(threads)
+    searcher = Searcher(
+        predict, 0, batch_size, stopped=stopped, collect_stats=collect_stats
+    )
+    while (request := connection.recv()) is not None:
+        board, deadline, nodes = request
+        searcher.search(board, deadline=deadline, nodes=nodes)
+        tree = searcher.tree
+        connection.send(
+            (
+                [
+                    (int(tree.move[child]), tree.value[child], tree.n_leaves[child])
+                    for child in tree.children(0)
+                ],
+                searcher.explored,
+                searcher.stats,
             )
-        if self.explored_children is None:
-            return self.score
-        return (
-            (1 - max(child.value() for child in self.explored_children))
-            ** (1 - self.score_override_coef)
-            * (self.score**self.score_override_coef)
-            * self.move_numbers_price(self.board.fullmove_number)
         )
 
-    def n_explored(self):
-        if self.explored_children is None:
-            return 1
-        return sum(child.n_explored() for child in self.explored_children)
 
-    def depth(self):
-        if self.explored_children is None:
-            return 0
-        return 1 + max(child.depth() for child in self.explored_children)
+class ParallelSearcher:
+    # Root-parallel search: every worker process keeps its own Searcher over
+    # a copy of `predict`, and the root moves are ranked by their values
+    # averaged over the workers, weighted by the leaves found under them.
+    # Node budgets are split between the workers. The processes run until
+    # close(), or the end of a with block.
+    def __init__(
+        self,
+        predict: Callable[[chess.Board], dict[chess.Move, float]],
+        n_scenarios: int,
+        batch_size: int = 1,
+        workers: int = 2,
+        noise: float = 0.05,
+        threads: int = 1,
+        collect_stats: bool = False,
+    ):
+        self.n_scenarios = n_scenarios
+        # Combined over the workers, see SearchStats.combine
+        self.stats: SearchStats | None = None
+        context = multiprocessing.get_context("spawn")
+        # Shared by the workers, cleared here when a search starts
+        self.stopped = context.Event()
+        self.searching = False
+        self.searching_lock = threading.Lock()
+        self.explored = 0
+        self.connections: list[Connection] = []
+        self.processes = []
+        for seed in range(workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=search_worker,
+                args=(
+                    worker_connection,
+                    predict if seed == 0 else NoisyPredictor(predict, noise, seed),
+                    batch_size,
+                    self.stopped,
+                    threads,
+                    collect_stats,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
 
+    def __call__(self, board: chess.Board) -> dict[chess.Move, float]:
+        return self.search(board, nodes=self.n_scenarios)
 
-def amplify(
-    board, predict: Callable[[chess.Board], dict[chess.Move, float]], n_scenarios: int
-) -> dict[chess.Move, float]:
-    scenario = Scenario(board=board, move=None, score=0, predict=predict)
-    while scenario.n_explored() < n_scenarios and scenario.expand():
-        pass
-    return {
-        child.move: child.value()
-        for child in scenario.explored_children or []
-        if child.move
-    }
+    def search(
+        self,
+        board: chess.Board,
+        deadline: float | None = None,
+        nodes: int | None = None,
+    ) -> dict[chess.Move, float]:
+        if nodes is not None:
+            nodes = -(-nodes // len(self.connections))
+        with self.searching_lock:
+            self.stopped.clear()
+            self.searching = True
+        try:
+            return self.run_search(board, deadline, nodes)
+        finally:
+            with self.searching_lock:
+                self.searching = False
 
+    def run_search(
+        self, board: chess.Board, deadline: float | None, nodes: int | None
+    ) -> dict[chess.Move, float]:
+        for connection in self.connections:
+            connection.send((board, deadline, nodes))
+        value_sums: dict[int, float] = {}
+        leaf_sums: dict[int, int] = {}
+        self.explored = 0
+        worker_stats = []
+        for connection in self.connections:
+            root_statistics, explored, stats = connection.recv()
+            self.explored += explored
+            if stats is not None:
+                worker_stats.append(stats)
+            for code, value, leaves in root_statistics:
+                value_sums[code] = value_sums.get(code, 0) + value * leaves
+                leaf_sums[code] = leaf_sums.get(code, 0) + leaves
+        self.stats = SearchStats.combine(worker_stats) if worker_stats else None
+        return {
+            code_to_move(code): value_sums[code] / leaf_sums[code]
+            for code in value_sums
+        }
 
-def amplified_predictor(predict, n):
-    def predictor(b):
-        return amplify(b, predict, n)
+    def stop(self):
+        with self.searching_lock:
+            if self.searching:
+                self.stopped.set()
 
-    return predictor
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self) -> "ParallelSearcher":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def make_searcher(
+    predict: Callable[[chess.Board], dict[chess.Move, float]],
+    n_scenarios: int,
+    batch_size: int = 1,
+    workers: int = 1,
+    collect_stats: bool = False,
+) -> Searcher | ParallelSearcher:
+    if workers > 1:
+        return ParallelSearcher(
+            predict, n_scenarios, batch_size, workers, collect_stats=collect_stats
+        )
+    return Searcher(predict, n_scenarios, batch_size, collect_stats=collect_stats)
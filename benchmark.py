@@ -0,0 +1,343 @@
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+
+import chess
+import chess.pgn
+import click
+import torch
+import yaml
+
+from amplify import amplify
+import generate_dataset
+from predict import Predictor
+from to_matrix import board_and_move_to_matrix, strategies_from_file
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_data")
+POSITIONS_PATH = os.path.join(DATA_DIR, "positions.fen")
+GAMES_PATH = os.path.join(DATA_DIR, "games.pgn")
+BATCH_SIZES = [1, 32, 256]
+N_SCENARIOS = [100, 400, 1600]
+# FENs read by strategies_from_file, out of about 20000 in the games
+N_FENS = 1000
+
+
+def load_positions() -> list[chess.Board]:
+    with open(POSITIONS_PATH, encoding="utf-8") as file:
+        return [chess.Board(line.strip()) for line in file if line.strip()]
+
+
+def best_time(function: Callable[[], object], repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def metric(value: float, unit: str, higher_is_better: bool = True) -> dict:
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+class CountingPredictor:
+    # Counts the positions the search sends to the network
+    def __init__(self, predictor: Predictor):
+        self.predictor = predictor
+        self.n_positions = 0
+
+    def __call__(self, board: chess.Board) -> dict[chess.Move, float]:
+        self.n_positions += 1
+        return self.predictor(board)
+
+    def predict_many(self, boards: list[chess.Board]) -> list[dict[chess.Move, float]]:
+        self.n_positions += len(boards)
+        return self.predictor.predict_many(boards)
+
+
+def bench_encoder(boards: list[chess.Board], repeats: int, **_) -> dict:
+    pairs = [(board, move) for board in boards for move in board.legal_moves]
+
+    def encode():
+        for board, move in pairs:
+            board_and_move_to_matrix(board, move)
+
+    seconds = best_time(encode, repeats)
+    return {"encoder.encodings_per_second": metric(len(pairs) / seconds, "1/s")}
+
+
+def bench_predictor(
+    boards: list[chess.Board], repeats: int, predictor: Predictor, **_
+) -> dict:
+    results = {}
+    for batch_size in BATCH_SIZES:
+        batch = (boards * -(-batch_size // len(boards)))[:batch_size]
+        predictor.predict_many(batch)
+        seconds = best_time(lambda: predictor.predict_many(batch), repeats)
+        results[f"predictor.batch_{batch_size}.positions_per_second"] = metric(
+            batch_size / seconds, "1/s"
+        )
+    return results
+
+
+def bench_amplify(
+    boards: list[chess.Board], repeats: int, predictor: Predictor, **_
+) -> dict:
+    results = {}
+    board = boards[0]
+    for n_scenarios in N_SCENARIOS:
+        counting = CountingPredictor(predictor)
+        seconds = best_time(lambda: amplify(board, counting, n_scenarios), repeats)
+        # Traced separately, tracemalloc slows the search down
+        tracemalloc.start()
+        amplify(board, predictor, n_scenarios)
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[f"amplify.n_{n_scenarios}.nodes_per_second"] = metric(
+            counting.n_positions / repeats / seconds, "1/s"
+        )
+        results[f"amplify.n_{n_scenarios}.peak_mib"] = metric(
+            peak / (1 << 20), "MiB", higher_is_better=False
+        )
+    return results
+
+
+def game_offsets() -> list[int]:
+    offsets = []
+    with open(GAMES_PATH) as pgn:
+        while True:
+            offset = pgn.tell()
+            if chess.pgn.read_headers(pgn) is None:
+                return offsets
+            offsets.append(offset)
+
+
+def games_moves() -> dict[str, list[str]]:
+    moves = generate_dataset.PositionMoves()
+    with open(GAMES_PATH) as pgn:
+        for offset in game_offsets():
+            generate_dataset.load_offset(pgn, offset, moves)
+    return moves.to_dict()
+
+
+def bench_strategies(repeats: int, directory: str, **_) -> dict:
+    path = os.path.join(directory, "moves.yaml")
+    with open(path, "w", encoding="utf-8") as file:
+        yaml.safe_dump(games_moves(), file)
+    n_strategies = 0
+
+    def load():
+        nonlocal n_strategies
+        n_strategies = sum(1 for _ in strategies_from_file(path, N_FENS))
+
+    # strategies_from_file prints its progress
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            seconds = best_time(load, repeats)
+        finally:
+            sys.stdout = stdout
+    return {
+        "strategies_from_file.seconds": metric(seconds, "s", higher_is_better=False),
+        "strategies_from_file.strategies_per_second": metric(
+            n_strategies / seconds, "1/s"
+        ),
+    }
+
+
+def bench_ingest(repeats: int, directory: str, **_) -> dict:
+    # A copy without a sidecar index, so the headers are scanned every time
+    path = os.path.join(directory, "games.pgn")
+    shutil.copy(GAMES_PATH, path)
+    n_positions = 0
+
+    def ingest():
+        nonlocal n_positions
+        blocks = generate_dataset.load_dataset(path, analyzed_games_per_rating=10**6)
+        n_positions = sum(len(moves) for _rating_range, moves in blocks)
+
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            seconds = best_time(ingest, repeats)
+        finally:
+            sys.stdout = stdout
+    return {
+        "ingest.games_per_second": metric(len(game_offsets()) / seconds, "1/s"),
+        "ingest.positions_per_second": metric(n_positions / seconds, "1/s"),
+    }
+
+
+BENCHMARKS = {
+    "encoder": bench_encoder,
+    "predictor": bench_predictor,
+    "amplify": bench_amplify,
+    "strategies": bench_strategies,
+    "ingest": bench_ingest,
+}
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    names: list[str],
+    repeats: int = 3,
+    checkpoint: str | None = None,
+    threads: int | None = None,
+) -> dict:
+    torch.manual_seed(0)
+    boards = load_positions()
+    predictor = Predictor(checkpoint, threads=threads)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            print(f"Running {name}", file=sys.stderr)
+            results.update(
+                BENCHMARKS[name](
+                    boards=boards,
+                    repeats=repeats,
+                    predictor=predictor,
+                    directory=directory,
+                )
+            )
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "threads": torch.get_num_threads(),
+            "checkpoint": checkpoint,
+        },
+        "results": results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    # Prints the change of every metric, returns the regressed ones
+    regressions = []
+    print(f"{'metric':<48}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name:<48}{'-':>12}{result['value']:>12.4g}")
+            continue
+        before = baseline["results"][name]["value"]
+        change = result["value"] / before - 1 if before else 0.0
+        worse = -change if result["higher_is_better"] else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<48}{before:>12.4g}{result['value']:>12.4g}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def write_data(n_positions: int = 64, n_games: int = 300, seed: int = 0):
+    # Regenerates the checked-in inputs: positions and games from seeded
+    # random play, with random ratings and time controls
+    rng = random.Random(seed)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(POSITIONS_PATH, "w", encoding="utf-8") as file:
+        n_written = 0
+        while n_written < n_positions:
+            board = chess.Board()
+            for _ in range(rng.randrange(100)):
+                if board.is_game_over():
+                    break
+                board.push(rng.choice(list(board.legal_moves)))
+            if not board.is_game_over():
+                print(board.fen(), file=file)
+                n_written += 1
+    with open(GAMES_PATH, "w", encoding="utf-8") as file:
+        for i in range(n_games):
+            board = chess.Board()
+            for _ in range(rng.randint(10, 120)):
+                if board.is_game_over():
+                    break
+                board.push(rng.choice(list(board.legal_moves)))
+            game = chess.pgn.Game.from_board(board)
+            game.headers["Event"] = f"Synthetic game {i}"
+            game.headers["WhiteElo"] = str(rng.randint(400, 3000))
+            game.headers["BlackElo"] = str(rng.randint(400, 3000))
+            game.headers["TimeControl"] = rng.choice(["60+0", "180+2", "600+5"])
+            print(game, file=file, end="\n\n")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("run")
+@click.option("--output", "-o", default=None, help="JSON file for the results")
+@click.option("--baseline", "-b", default=None, help="JSON results to compare to")
+@click.option("--only", multiple=True, type=click.Choice(list(BENCHMARKS)))
+@click.option("--repeats", default=3)
+@click.option("--checkpoint", default=None)
+@click.option("--threads", default=None, type=int)
+@click.option("--tolerance", default=0.1, help="Allowed relative slowdown")
+def run_command(
+    output: str | None,
+    baseline: str | None,
+    only: list[str],
+    repeats: int,
+    checkpoint: str | None,
+    threads: int | None,
+    tolerance: float,
+):
+    results = run(list(only or BENCHMARKS), repeats, checkpoint, threads)
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if baseline:
+        with open(baseline, encoding="utf-8") as file:
+            regressions = compare_results(json.load(file), results, tolerance)
+        sys.exit(1 if regressions else 0)
+    for name, result in results["results"].items():
+        print(f"{name:<48}{result['value']:>12.4g} {result['unit']}")
+
+
+@cli.command()
+@click.argument("baseline")
+@click.argument("current")
+@click.option("--tolerance", default=0.1, help="Allowed relative slowdown")
+def compare(baseline: str, current: str, tolerance: float):
+    with open(baseline, encoding="utf-8") as file:
+        before = json.load(file)
+    with open(current, encoding="utf-8") as file:
+        after = json.load(file)
+    regressions = compare_results(before, after, tolerance)
+    if regressions:
+        print(f"{len(regressions)} regressions above {tolerance:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+@cli.command("write-data")
+def write_data_command():
+    write_data()
+    print(f"Wrote {POSITIONS_PATH} and {GAMES_PATH}")
+
+
+if __name__ == "__main__":
+    cli()
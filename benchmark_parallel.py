@@ -0,0 +1,52 @@
+import time
+
+import chess
+import click
+import torch
+
+from amplify import ParallelSearcher
+from predict import Predictor
+
+POSITIONS = [
+    chess.STARTING_FEN,
+    "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+    "r2q1rk1/ppp2ppp/2np1n2/2b1p1B1/2B1P1b1/2NP1N2/PPP2PPP/R2Q1RK1 w - - 6 8",
+    "8/5pk1/6p1/3R4/7P/6P1/r4PK1/8 b - - 3 41",
+]
+
+
+@click.command()
+@click.option("--checkpoint", default=None)
+@click.option("--workers", "-w", multiple=True, type=int, default=[1, 2, 4, 8, 16])
+@click.option("--movetime", default=2.0)
+@click.option("--batch-size", default=16)
+def main(checkpoint: str | None, workers: list[int], movetime: float, batch_size: int):
+    torch.manual_seed(0)
+    predictor = Predictor(checkpoint)
+    print(
+        f"{'workers':>8}{'nodes':>10}{'nodes/s':>10}{'speedup':>10}{'efficiency':>12}"
+    )
+    baseline = None
+    for n_workers in workers:
+        searcher = ParallelSearcher(predictor, 0, batch_size, n_workers)
+        # The first search pays for starting the workers
+        searcher.search(chess.Board(), nodes=100)
+        explored = 0
+        elapsed = 0.0
+        for fen in POSITIONS:
+            start = time.monotonic()
+            searcher.search(chess.Board(fen), deadline=start + movetime)
+            elapsed += time.monotonic() - start
+            explored += searcher.explored
+        searcher.close()
+        nodes_per_second = explored / elapsed
+        baseline = baseline or nodes_per_second / n_workers
+        speedup = nodes_per_second / baseline
+        print(
+            f"{n_workers:>8}{explored:>10}{nodes_per_second:>10.0f}"
+            f"{speedup:>10.2f}{speedup / n_workers:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+import math
+import random
+import time
+import tracemalloc
+from typing import Callable
+
+import chess
+import click
+
+from search_tree import SearchTree
+
+
+# The tree of dataclass nodes amplify used before SearchTree, kept as the
+# reference SearchTree is measured against
+@dataclass
+class Scenario:
+    board: chess.Board
+    move: chess.Move | None
+    score: float
+    predict: Callable[[chess.Board], dict[chess.Move, float]]
+    explored_children: list[Scenario] | None = None
+    depth_coef: float = 1.25
+    rewarded_move_number: float = 24
+    score_override_coef: float = 0.1
+    # Cached aggregates, kept up to date along the path to the root
+    parent: Scenario | None = field(default=None, repr=False, compare=False)
+    n_leaves: int = field(default=1, repr=False, compare=False)
+    game_over: bool | None = field(default=None, repr=False, compare=False)
+    cached_expansion_probability: float | None = field(
+        default=None, repr=False, compare=False
+    )
+    cached_value: float | None = field(default=None, repr=False, compare=False)
+
+    def expand(self) -> bool:
+        scenario = self
+        while scenario.explored_children is not None:
+            scenario = max(
+                scenario.explored_children,
+                key=lambda child: child.expansion_probability(),
+            )
+
+        # if trying to expand a game over scenario, return False
+        if scenario.is_game_over():
+            return False
+
+        scenario.explored_children = []
+        for move, score in scenario.predict(scenario.board).items():
+            board = scenario.board.copy()
+            board.push(move)
+            scenario.explored_children.append(
+                Scenario(
+                    board=board,
+                    move=move,
+                    score=score,
+                    predict=scenario.predict,
+                    parent=scenario,
+                )
+            )
+        scenario.backpropagate(len(scenario.explored_children) - 1)
+        return True
+
+    def backpropagate(self, new_leaves: int):
+        scenario: Scenario | None = self
+        while scenario is not None:
+            scenario.n_leaves += new_leaves
+            scenario.update_statistics()
+            scenario = scenario.parent
+
+    def is_game_over(self) -> bool:
+        if self.game_over is None:
+            self.game_over = self.board.is_game_over()
+        return self.game_over
+
+    def update_statistics(self):
+        # Special treatment for game over scenarios
+        if self.is_game_over():
+            self.cached_expansion_probability = 0
+            # We return 1 for a win, 0 for a loss, and 0.5 for a draw
+            result = self.board.result()
+            self.cached_value = (
+                1 if result == "1-0" else (0 if result == "0-1" else 0.5)
+            )
+            return
+        if self.explored_children is None:
+            self.cached_expansion_probability = self.score
+            self.cached_value = self.score
+            return
+        self.cached_expansion_probability = (
+            sum(
+                child.expansion_probability() ** 2 / self.depth_coef
+                for child in self.explored_children
+            )
+            / len(self.explored_children)
+        ) ** 0.5
+        self.cached_value = (
+            (1 - max(child.value() for child in self.explored_children))
+            ** (1 - self.score_override_coef)
+            * (self.score**self.score_override_coef)
+            * self.move_numbers_price(self.board.fullmove_number)
+        )
+
+    def expansion_probability(self):
+        if self.cached_expansion_probability is None:
+            self.update_statistics()
+        return self.cached_expansion_probability
+
+    def move_numbers_price(self, moves: int):
+        sigmoid_value = math.exp(moves / self.rewarded_move_number) / (
+            1 + math.exp(moves / self.rewarded_move_number)
+        )
+        return sigmoid_value * 2 - 1
+
+    def value(self):
+        if self.cached_value is None:
+            self.update_statistics()
+        return self.cached_value
+
+    def n_explored(self):
+        return self.n_leaves
+
+    def depth(self):
+        if self.explored_children is None:
+            return 0
+        return 1 + max(child.depth() for child in self.explored_children)
+
+
+def seeded_predict(seed: int = 0):
+    # Cheap deterministic stand-in for a network, so the benchmark only
+    # measures the tree itself
+    def predict(board: chess.Board) -> dict[chess.Move, float]:
+        rng = random.Random(f"{seed}:{board.fen()}")
+        return {move: rng.random() for move in board.legal_moves}
+
+    return predict
+
+
+def count_scenarios(scenario: Scenario) -> int:
+    return 1 + sum(count_scenarios(child) for child in scenario.explored_children or [])
+
+
+def measure(build) -> tuple[int, float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    tree = build()
+    elapsed = time.perf_counter() - start
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    nodes = count_scenarios(tree) if isinstance(tree, Scenario) else tree.size
+    del tree
+    return nodes, elapsed, current
+
+
+def build_scenario_tree(board: chess.Board, predict, n_scenarios: int) -> Scenario:
+    scenario = Scenario(board=board, move=None, score=0, predict=predict)
+    while scenario.n_explored() < n_scenarios and scenario.expand():
+        pass
+    return scenario
+
+
+def build_search_tree(board: chess.Board, predict, n_scenarios: int) -> SearchTree:
+    tree = SearchTree(board, predict)
+    while tree.n_explored() < n_scenarios and tree.expand():
+        pass
+    return tree
+
+
+@click.command()
+@click.option("--fen", default=chess.STARTING_FEN)
+@click.option(
+    "--n-scenarios", "-n", multiple=True, type=int, default=[1000, 10000, 50000]
+)
+def main(fen: str, n_scenarios: list[int]):
+    board = chess.Board(fen)
+    print(
+        f"{'tree':<12}{'n_scenarios':>12}{'nodes':>10}{'seconds':>10}"
+        f"{'nodes/s':>10}{'MiB':>10}{'bytes/node':>12}"
+    )
+    for n in n_scenarios:
+        for name, build in [
+            ("dataclass", build_scenario_tree),
+            ("array", build_search_tree),
+        ]:
+            nodes, elapsed, memory = measure(
+                lambda: build(board.copy(), seeded_predict(), n)
+            )
+            print(
+                f"{name:<12}{n:>12}{nodes:>10}{elapsed:>10.2f}"
+                f"{nodes / elapsed:>10.0f}{memory / 2**20:>10.1f}{memory / nodes:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
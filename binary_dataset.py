@@ -0,0 +1,255 @@
+import glob
+from typing import Iterator
+
+import chess
+import click
+import numpy as np
+import yaml
+
+from to_matrix import (
+    CASTLING_SQUARES,
+    POLICY_SIZE,
+    board_bitboards,
+    bitboards_to_planes,
+    codes_to_policy_indices,
+    move_to_code,
+    pack_castling,
+    positions_to_policy_planes,
+)
+
+POSITION_DTYPE = np.dtype(
+    [
+        ("bitboards", "<u8", (12,)),
+        ("turn", "u1"),
+        ("castling", "u1"),
+        ("ep_square", "i1"),
+        # Number of human moves seen in the position, it caps how many
+        # non-human moves are sampled like in strategies_from_fen
+        ("n_played", "<u4"),
+        ("move_start", "<u8"),
+        ("move_count", "<u2"),
+    ]
+)
+
+
+def unpack_board(position: np.void) -> chess.Board:
+    board = chess.Board.empty()
+    for plane, bitboard in enumerate(position["bitboards"].tolist()):
+        piece = chess.Piece(plane % 6 + 1, plane >= 6)
+        for square in chess.scan_forward(bitboard):
+            board.set_piece_at(square, piece)
+    board.turn = bool(position["turn"])
+    board.castling_rights = sum(
+        chess.BB_SQUARES[square]
+        for i, square in enumerate(CASTLING_SQUARES)
+        if position["castling"] >> i & 1
+    )
+    board.ep_square = None if position["ep_square"] < 0 else int(position["ep_square"])
+    return board
+
+
+class ShardWriter:
+    def __init__(self, prefix: str, shard_size: int = 50000):
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.n_shards = 0
+        self.positions: list[tuple] = []
+        self.moves: list[np.ndarray] = []
+        self.ratings: list[np.ndarray] = []
+        self.n_moves = 0
+
+    def add(self, board: chess.Board, move_counts: dict[chess.Move, int]):
+        # Every legal move is stored, the moves that were never played get a
+        # rating of 0. Ratings are float32, in float16 the share of a move in
+        # a position seen very often underflows.
+        n_played = sum(move_counts.values())
+        legal_moves = list(board.legal_moves)
+        self.positions.append(
+            (
+                board_bitboards(board),
+                board.turn,
+                pack_castling(board),
+                -1 if board.ep_square is None else board.ep_square,
+                n_played,
+                self.n_moves,
+                len(legal_moves),
+            )
+        )
+        self.moves.append(np.array([move_to_code(m) for m in legal_moves], "<u2"))
+        self.ratings.append(
+            np.array(
+                [move_counts.get(move, 0) / n_played for move in legal_moves], "<f4"
+            )
+        )
+        self.n_moves += len(legal_moves)
+        if len(self.positions) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.positions:
+            return
+        path = f"{self.prefix}_{self.n_shards:05d}"
+        np.save(f"{path}.positions.npy", np.array(self.positions, POSITION_DTYPE))
+        np.save(f"{path}.moves.npy", np.concatenate(self.moves))
+        np.save(f"{path}.ratings.npy", np.concatenate(self.ratings))
+        self.n_shards += 1
+        self.positions, self.moves, self.ratings = [], [], []
+        self.n_moves = 0
+
+    def close(self):
+        self.flush()
+
+
+def convert(yaml_path: str, prefix: str, shard_size: int = 50000) -> int:
+    with open(yaml_path, "r") as file:
+        data = yaml.load(file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    writer = ShardWriter(prefix, shard_size)
+    for i, (fen, moves) in enumerate(data.items()):
+        board = chess.Board(fen)
+        move_counts: dict[chess.Move, int] = {}
+        for san in moves:
+            move = board.parse_san(san)
+            move_counts[move] = move_counts.get(move, 0) + 1
+        writer.add(board, move_counts)
+        if not i % 10000:
+            print(f"Converted {i}/{len(data)} FENs", end="\r")
+    writer.close()
+    print(f"Converted {len(data)} FENs into {writer.n_shards} shards")
+    return writer.n_shards
+
+
+class Shard:
+    def __init__(self, path: str):
+        self.positions = np.load(f"{path}.positions.npy", mmap_mode="r")
+        self.moves = np.load(f"{path}.moves.npy", mmap_mode="r")
+        self.ratings = np.load(f"{path}.ratings.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def candidates(self, index: int, rng: np.random.Generator) -> np.ndarray:
+        # Same selection as strategies_from_fen: shuffle the legal moves, keep
+        # the human ones and as many others as there were human moves played
+        position = self.positions[index]
+        start = int(position["move_start"])
+        order = start + rng.permutation(int(position["move_count"]))
+        human = self.ratings[order] > 0
+        non_human = np.cumsum(~human)
+        return order[human | (non_human <= position["n_played"])]
+
+    def decode(
+        self, indices: np.ndarray, candidates: list[np.ndarray]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        counts = [len(c) for c in candidates]
+        moves = np.concatenate(candidates) if candidates else np.empty(0, np.int64)
+        codes = self.moves[moves].astype(np.int64)
+        matrix = np.zeros((len(moves), 14, 64), dtype=np.float32)
+        planes = bitboards_to_planes(self.positions["bitboards"][indices])
+        matrix[:, :12] = np.repeat(planes.reshape(len(indices), 12, 64), counts, axis=0)
+        rows = np.arange(len(moves))
+        matrix[rows, -1, codes & 63] = 1
+        matrix[rows, -2, codes >> 6 & 63] = 1
+        return matrix.reshape(-1, 14, 8, 8), self.ratings[moves].astype(np.float32)
+
+    def decode_policy(
+        self, indices: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Board planes, the move frequencies spread over the POLICY_SIZE
+        # outputs and the mask of the legal moves, one row per position
+        positions = self.positions[indices]
+        counts = positions["move_count"].astype(np.int64)
+        starts = positions["move_start"].astype(np.int64)
+        moves = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        rows = np.repeat(np.arange(len(indices)), counts)
+        columns = codes_to_policy_indices(self.moves[moves])
+        targets = np.zeros((len(indices), POLICY_SIZE), dtype=np.float32)
+        targets[rows, columns] = self.ratings[moves]
+        targets /= np.maximum(targets.sum(axis=1, keepdims=True), 1e-6)
+        legal = np.zeros((len(indices), POLICY_SIZE), dtype=bool)
+        legal[rows, columns] = True
+        planes = positions_to_policy_planes(
+            positions["bitboards"],
+            positions["turn"],
+            positions["castling"],
+            positions["ep_square"],
+        )
+        return planes, targets, legal
+
+
+class BinaryDataset:
+    def __init__(self, prefix: str):
+        self.shards = [
+            Shard(path.removesuffix(".positions.npy"))
+            for path in sorted(glob.glob(f"{glob.escape(prefix)}_*.positions.npy"))
+        ]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def batches(
+        self,
+        positions_per_batch: int = 256,
+        shuffle: bool = True,
+        seed: int | None = None,
+        part: int = 0,
+        n_parts: int = 1,
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        # Yields (planes, ratings) with the planes decoded batch by batch
+        rng = np.random.default_rng(None if seed is None else [seed, part])
+        for shard, indices in self.batch_indices(
+            positions_per_batch, shuffle, seed, part, n_parts
+        ):
+            yield shard.decode(indices, [shard.candidates(i, rng) for i in indices])
+
+    def policy_batches(
+        self,
+        positions_per_batch: int = 256,
+        shuffle: bool = True,
+        seed: int | None = None,
+        part: int = 0,
+        n_parts: int = 1,
+    ) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        # Yields (planes, targets, legal) for a PolicyNetwork, see decode_policy
+        for shard, indices in self.batch_indices(
+            positions_per_batch, shuffle, seed, part, n_parts
+        ):
+            yield shard.decode_policy(indices)
+
+    def batch_indices(
+        self,
+        positions_per_batch: int,
+        shuffle: bool,
+        seed: int | None,
+        part: int,
+        n_parts: int,
+    ) -> Iterator[tuple[Shard, np.ndarray]]:
+        # Readers sharing a seed and n_parts get disjoint parts of the same
+        # shuffled order, without a seed every reader shuffles differently
+        if shuffle and seed is None and n_parts > 1:
+            raise ValueError("Shuffled parts need a seed shared by the readers")
+        order_rng = np.random.default_rng(seed)
+        shard_ids = list(range(len(self.shards)))
+        if shuffle:
+            order_rng.shuffle(shard_ids)
+        for shard_id in shard_ids:
+            shard = self.shards[shard_id]
+            if shuffle:
+                order = order_rng.permutation(len(shard))[part::n_parts]
+            else:
+                order = np.arange(part, len(shard), n_parts)
+            for start in range(0, len(order), positions_per_batch):
+                yield shard, np.sort(order[start : start + positions_per_batch])
+
+
+@click.command()
+@click.argument("yaml_path")
+@click.argument("prefix")
+@click.option("--shard-size", default=50000)
+def main(yaml_path: str, prefix: str, shard_size: int):
+    convert(yaml_path, prefix, shard_size)
+
+
+if __name__ == "__main__":
+    main()
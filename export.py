@@ -0,0 +1,185 @@
+import os
+import random
+import tempfile
+import time
+
+import chess
+import click
+import numpy as np
+import torch
+
+from predict import Predictor
+from to_matrix import POLICY_PLANES
+
+try:
+    import onnx
+    import onnxruntime.quantization
+except ImportError:
+    onnx = None
+
+BATCH_SIZES = [1, 32, 256]
+
+
+def export(
+    checkpoint: str,
+    output: str,
+    quantize: bool = False,
+    policy: bool | None = None,
+    network_params: tuple = (),
+):
+    # Writes a TorchScript (.ts) or ONNX (.onnx) artifact that Predictor
+    # loads like a checkpoint. quantize stores the Linear layers as int8.
+    predictor = Predictor(checkpoint, *network_params, policy=policy)
+    network = predictor.network
+    family = "policy" if predictor.policy else "network"
+    example = torch.zeros(1, POLICY_PLANES if predictor.policy else 14, 8, 8)
+    if output.endswith(".ts"):
+        if quantize:
+            network = torch.ao.quantization.quantize_dynamic(
+                network, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        with torch.no_grad():
+            module = torch.jit.freeze(torch.jit.trace(network, example).eval())
+        torch.jit.save(module, output, _extra_files={"family": family})
+    elif output.endswith(".onnx"):
+        if onnx is None:
+            raise ImportError("ONNX export needs the onnx and onnxruntime packages")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "float.onnx") if quantize else output
+            torch.onnx.export(
+                network,
+                (example,),
+                path,
+                input_names=["planes"],
+                output_names=["scores"],
+                dynamic_axes={"planes": {0: "batch"}, "scores": {0: "batch"}},
+                dynamo=False,
+            )
+            if quantize:
+                onnxruntime.quantization.quantize_dynamic(
+                    path,
+                    output,
+                    op_types_to_quantize=["MatMul", "Gemm"],
+                    weight_type=onnxruntime.quantization.QuantType.QInt8,
+                )
+        model = onnx.load(output)
+        onnx.helper.set_model_props(model, {"family": family})
+        onnx.save(model, output)
+    else:
+        raise ValueError(f"{output} should end with .ts or .onnx")
+
+
+def sample_positions(n: int, seed: int = 0) -> list[chess.Board]:
+    # Positions reached by random play, none of them game over
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < n:
+        board = chess.Board()
+        for _ in range(rng.randrange(80)):
+            if board.is_game_over():
+                break
+            board.push(rng.choice(list(board.legal_moves)))
+        if not board.is_game_over():
+            boards.append(board)
+    return boards
+
+
+def latency(predictor: Predictor, boards: list[chess.Board], repeats: int) -> float:
+    predictor.predict_many(boards)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predictor.predict_many(boards)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def average_ranks(values: np.ndarray) -> np.ndarray:
+    # Ranks where tied values share their mean rank, as Spearman's needs
+    order = np.argsort(values, kind="stable")
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(len(values))
+    _unique, inverse, counts = np.unique(
+        values, return_inverse=True, return_counts=True
+    )
+    return (np.bincount(inverse, ranks) / counts)[inverse]
+
+
+def ranking_agreement(
+    reference: list[dict[chess.Move, float]], predictions: list[dict[chess.Move, float]]
+) -> tuple[float, float, int]:
+    # Share of positions with the same best move, mean Spearman correlation
+    # of the move scores and the number of positions they are computed on.
+    # Positions with fewer than 2 moves or constant scores rank nothing and
+    # are skipped.
+    top_moves = 0
+    correlations = []
+    for expected, predicted in zip(reference, predictions):
+        moves = list(expected)
+        scores = [
+            np.array([prediction[move] for move in moves], dtype=np.float64)
+            for prediction in (expected, predicted)
+        ]
+        if len(moves) < 2 or not scores[0].std() or not scores[1].std():
+            continue
+        top_moves += max(moves, key=expected.get) == max(moves, key=predicted.get)
+        correlations.append(np.corrcoef(*map(average_ranks, scores))[0, 1])
+    if not correlations:
+        return 0.0, 0.0, 0
+    return (
+        top_moves / len(correlations),
+        float(np.mean(correlations)),
+        len(correlations),
+    )
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("export")
+@click.argument("checkpoint")
+@click.argument("output")
+@click.option("--quantize", is_flag=True, help="Dynamic int8 Linear layers")
+@click.option("--policy/--no-policy", default=None, help="Model family")
+def export_command(checkpoint: str, output: str, quantize: bool, policy: bool | None):
+    export(checkpoint, output, quantize, policy)
+    print(f"Exported {checkpoint} into {output}")
+
+
+@cli.command()
+@click.argument("reference")
+@click.argument("models", nargs=-1)
+@click.option("--positions", "n_positions", default=256)
+@click.option("--repeats", default=20)
+@click.option("--threads", default=None, type=int)
+def compare(
+    reference: str,
+    models: list[str],
+    n_positions: int,
+    repeats: int,
+    threads: int | None,
+):
+    boards = sample_positions(max(n_positions, max(BATCH_SIZES)))
+    expected = Predictor(reference, threads=threads).predict_many(boards)
+    print(
+        f"{'model':>24}{'batch':>7}{'ms/call':>10}{'pos/s':>10}"
+        f"{'top-1':>8}{'spearman':>10}{'ranked':>8}"
+    )
+    for path in [reference, *models]:
+        predictor = Predictor(path, threads=threads)
+        top_moves, correlation, n_ranked = ranking_agreement(
+            expected, predictor.predict_many(boards)
+        )
+        for batch_size in BATCH_SIZES:
+            seconds = latency(predictor, boards[:batch_size], repeats)
+            print(
+                f"{os.path.basename(path):>24}{batch_size:>7}{seconds * 1000:>10.2f}"
+                f"{batch_size / seconds:>10.0f}{top_moves:>8.3f}{correlation:>10.3f}"
+                f"{n_ranked:>8}"
+            )
+
+
+if __name__ == "__main__":
+    cli()
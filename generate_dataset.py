@@ -1,28 +1,52 @@
+from functools import partial
+from multiprocessing import Pool
+import os
 from typing import Iterator, TextIO
 
 import chess
 import chess.pgn
+import click
 import yaml
 
+from pgn_index import GameIndex, index_path
+from pgn_io import compression, frames_path, open_pgn
+from to_matrix import PositionKey, code_to_move, key_board, move_to_code, position_key
+
+CATEGORIES = [400, 800, 1200, 1600, 2000, 2400, 2800, 3200]
+
+
+def rating_ranges(categories: list[int]) -> list[tuple[int, int]]:
+    return [
+        (([0] + categories)[i], ([0] + categories)[i + 1])
+        for i in range(len(categories))
+    ]
+
+
+def header_elos(headers: chess.pgn.Headers) -> tuple[int, ...] | None:
+    elos = headers.get("WhiteElo"), headers.get("BlackElo")
+    if any(not (i and i.isnumeric()) for i in elos):
+        return None
+    return tuple(int(i or 0) for i in elos)
+
+
+def rating_range_for(
+    elos: tuple[int, ...], ranges: list[tuple[int, int]]
+) -> tuple[int, int] | None:
+    for rating_range in ranges:
+        if any(rating_range[0] <= elo <= rating_range[1] for elo in elos):
+            return rating_range
+    return None
+
 
 def load_offsets(
     pgn: TextIO,
     analyzed_games_per_rating: int = 6000,
     max_analyzed_games: int = 500000,
-    categories=[
-        400,
-        800,
-        1200,
-        1600,
-        2000,
-        2400,
-        2800,
-        3200,
-    ],
+    categories=CATEGORIES,
 ) -> dict[tuple[int, int], list[int]]:
-    rating_based_offsets: dict[tuple[int, int], list[int]] = {}
-    for i in range(len(categories)):
-        rating_based_offsets[(([0] + categories)[i], ([0] + categories)[i + 1])] = []
+    rating_based_offsets: dict[tuple[int, int], list[int]] = {
+        rating_range: [] for rating_range in rating_ranges(categories)
+    }
 
     count = 0
     while count < max_analyzed_games:
@@ -34,17 +58,16 @@ def load_offsets(
         ):
             break
 
-        elos = headers.get("WhiteElo"), headers.get("BlackElo")
-        if any(not (i and i.isnumeric()) for i in elos):
+        elos = header_elos(headers)
+        if elos is None:
             continue
 
-        elos = tuple(int(i or 0) for i in elos)
-        for rating_range in rating_based_offsets:
-            if any(rating_range[0] <= elo <= rating_range[1] for elo in elos):
-                if len(rating_based_offsets[rating_range]) >= analyzed_games_per_rating:
-                    break
-                rating_based_offsets[rating_range].append(offset)
-                break
+        rating_range = rating_range_for(elos, list(rating_based_offsets))
+        if (
+            rating_range is not None
+            and len(rating_based_offsets[rating_range]) < analyzed_games_per_rating
+        ):
+            rating_based_offsets[rating_range].append(offset)
 
         count += 1
         if not count % 1000:
@@ -58,36 +81,123 @@ def load_offsets(
     return rating_based_offsets
 
 
-def load_offset(pgn: TextIO, offset: int, moves: dict[str, list[str]]) -> None:
+def indexed_offsets(
+    path: str,
+    analyzed_games_per_rating: int = 6000,
+    max_analyzed_games: int = 500000,
+    categories=CATEGORIES,
+) -> dict[tuple[int, int], list[int]] | None:
+    # Same result as load_offsets, read from the sidecar index written by
+    # pgn_index.py instead of the PGN headers when there is one
+    if not os.path.exists(index_path(path)):
+        return None
+    return GameIndex.open(path).rating_buckets(
+        analyzed_games_per_rating, max_analyzed_games, categories
+    )
+
+
+class MainlineVisitor(chess.pgn.BaseVisitor):
+    # Collects the position key and move code of every mainline move while
+    # the game is parsed, without building the GameNode tree, replaying the
+    # game from the root or formatting any strings.
+    # Variations are skipped unparsed, so an illegal move inside a variation
+    # is not an error any more and the game is kept for its mainline.
+    def begin_game(self):
+        self.positions: list[tuple[PositionKey, int]] = []
+        self.errors: list[Exception] = []
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        self.positions.append((position_key(board), move_to_code(move)))
+
+    def handle_error(self, error: Exception):
+        self.errors.append(error)
+
+    def result(self):
+        return self
+
+
+class PositionMoves:
+    # The moves played in every position of many games, as position keys and
+    # move codes. FEN and SAN strings are only built by to_dict(), once per
+    # position and once per distinct move in it.
+    def __init__(self):
+        self.codes: dict[PositionKey, list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def add_game(self, game: MainlineVisitor):
+        for key, code in game.positions:
+            if key in self.codes:
+                self.codes[key].append(code)
+            else:
+                self.codes[key] = [code]
+
+    def to_dict(self) -> dict[str, list[str]]:
+        # FEN -> SAN of the moves in the order they were played
+        moves = {}
+        for key, codes in self.codes.items():
+            board = key_board(key)
+            sans: dict[int, str] = {}
+            for code in codes:
+                if code not in sans:
+                    sans[code] = board.san(code_to_move(code))
+            moves[board.fen(en_passant="fen")] = [sans[code] for code in codes]
+        return moves
+
+
+def load_offset(pgn: TextIO, offset: int, moves: PositionMoves) -> int:
     pgn.seek(offset)
-    game_start = chess.pgn.read_game(pgn)
-    if not game_start or game_start.errors:
-        return
-    board = game_start.board()
-    prev_fen = board.fen(en_passant="fen")
-    game = game_start.next()
-    while game:
-        board = game.board()
-        fen = board.fen(en_passant="fen")
-        move = str(game.san())
-        if prev_fen in moves:
-            moves[prev_fen].append(move)
-        else:
-            moves[prev_fen] = [move]
-        prev_fen = fen
-        game = game.next()
+    game = chess.pgn.read_game(pgn, Visitor=MainlineVisitor)
+    if not game or game.errors:
+        return 0
+    moves.add_game(game)
+    return len(game.positions)
+
+
+def load_blocks_in_file_order(
+    pgn: TextIO, rating_based_offsets: dict[tuple[int, int], list[int]]
+) -> Iterator[tuple[tuple[int, int], dict[str, list[str]]]]:
+    # Reads the games of every block in a single forward pass. The offsets of
+    # each block are in file order already, so the dicts are the same as when
+    # the blocks are read one after the other.
+    blocks: dict[tuple[int, int], PositionMoves] = {
+        rating_range: PositionMoves() for rating_range in rating_based_offsets
+    }
+    games = sorted(
+        (offset, rating_range)
+        for rating_range, offsets in rating_based_offsets.items()
+        for offset in offsets
+    )
+    for game_id, (offset, rating_range) in enumerate(games):
+        load_offset(pgn, offset, blocks[rating_range])
+        if not game_id % 100:
+            print(f"{game_id}/{len(games)} games", end="\r")
+    print(f"Loaded {len(games)} games")
+    for rating_range, moves in blocks.items():
+        yield rating_range, moves.to_dict()
 
 
 def load_dataset(
     path: str, analyzed_games_per_rating: int = 6000
 ) -> Iterator[tuple[tuple[int, int], dict[str, list[str]]]]:
-    pgn = open(path)
+    pgn = open_pgn(path)
 
-    rating_based_offsets = load_offsets(pgn, analyzed_games_per_rating)
+    rating_based_offsets = indexed_offsets(path, analyzed_games_per_rating)
+    if rating_based_offsets is None:
+        rating_based_offsets = load_offsets(pgn, analyzed_games_per_rating)
     print()
     print("Loaded offsets")
+    if compression(path) is not None:
+        # Going back to the start of the stream for every block would
+        # decompress the file once per block
+        yield from load_blocks_in_file_order(pgn, rating_based_offsets)
+        return
     for block_id, (rating_range, offsets) in enumerate(rating_based_offsets.items()):
-        rating_moves: dict[str, list[str]] = {}
+        rating_moves = PositionMoves()
         for game_id, offset in enumerate(offsets):
             load_offset(pgn, offset, rating_moves)
             if not game_id % 100:
@@ -98,7 +208,170 @@ def load_dataset(
         print(
             f"Loaded {len(offsets)} games from block {block_id}/{len(rating_based_offsets)}"
         )
-        yield rating_range, rating_moves
+        yield rating_range, rating_moves.to_dict()
+
+
+def event_boundaries(path: str, n_ranges: int) -> list[int]:
+    # Splits the file into byte ranges that each start at an "[Event" line
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as file:
+        for i in range(1, n_ranges):
+            file.seek(max(size * i // n_ranges, boundaries[-1]))
+            file.readline()
+            while True:
+                offset = file.tell()
+                line = file.readline()
+                if not line or line.startswith(b"[Event "):
+                    break
+            if boundaries[-1] < offset < size:
+                boundaries.append(offset)
+    return boundaries + [size]
+
+
+def scan_range(
+    path: str,
+    start: int,
+    end: int,
+    analyzed_games_per_rating: int,
+    max_analyzed_games: int,
+    categories: list[int],
+) -> tuple[int | None, dict[tuple[int, int], list[tuple[int, int]]]]:
+    # Same filtering as load_offsets over one byte range. Offsets are kept with
+    # the number of games with valid ratings before them in the range, so the
+    # global max_analyzed_games cut can be applied after merging. The count is
+    # None when the range filled every rating range, as no later range matters
+    # then.
+    offsets: dict[tuple[int, int], list[tuple[int, int]]] = {
+        rating_range: [] for rating_range in rating_ranges(categories)
+    }
+    count = 0
+    with open(path) as pgn:
+        pgn.seek(start)
+        while count < max_analyzed_games:
+            offset = pgn.tell()
+            if offset >= end:
+                break
+            headers = chess.pgn.read_headers(pgn)
+            if headers is None:
+                break
+            if all(len(o) >= analyzed_games_per_rating for o in offsets.values()):
+                return None, offsets
+            elos = header_elos(headers)
+            if elos is None:
+                continue
+            rating_range = rating_range_for(elos, list(offsets))
+            if (
+                rating_range is not None
+                and len(offsets[rating_range]) < analyzed_games_per_rating
+            ):
+                offsets[rating_range].append((count, offset))
+            count += 1
+    return count, offsets
+
+
+def load_offsets_parallel(
+    path: str,
+    pool: Pool,
+    n_ranges: int,
+    analyzed_games_per_rating: int = 6000,
+    max_analyzed_games: int = 500000,
+    categories=CATEGORIES,
+) -> dict[tuple[int, int], list[int]]:
+    boundaries = event_boundaries(path, n_ranges)
+    scans = pool.starmap(
+        scan_range,
+        [
+            (
+                path,
+                start,
+                end,
+                analyzed_games_per_rating,
+                max_analyzed_games,
+                categories,
+            )
+            for start, end in zip(boundaries, boundaries[1:])
+        ],
+    )
+    rating_based_offsets: dict[tuple[int, int], list[int]] = {
+        rating_range: [] for rating_range in rating_ranges(categories)
+    }
+    analyzed = 0
+    for count, offsets in scans:
+        for rating_range, range_offsets in offsets.items():
+            rating_based_offsets[rating_range].extend(
+                offset
+                for ordinal, offset in range_offsets
+                if analyzed + ordinal < max_analyzed_games
+            )
+            del rating_based_offsets[rating_range][analyzed_games_per_rating:]
+        if count is None:
+            break
+        analyzed += count
+    return rating_based_offsets
+
+
+def load_offsets_moves(path: str, offsets: list[int]) -> dict[str, list[str]]:
+    # The strings are built in the worker, the parent only merges them
+    moves = PositionMoves()
+    with open_pgn(path) as pgn:
+        for offset in offsets:
+            load_offset(pgn, offset, moves)
+    return moves.to_dict()
+
+
+def load_dataset_parallel(
+    path: str,
+    analyzed_games_per_rating: int = 6000,
+    workers: int | None = None,
+    max_analyzed_games: int = 500000,
+    categories=CATEGORIES,
+) -> Iterator[tuple[tuple[int, int], dict[str, list[str]]]]:
+    if compression(path) is not None and not os.path.exists(frames_path(path)):
+        # Without frames every worker would decompress the file from the start
+        print("No frame index for the compressed file, loading it in one pass")
+        yield from load_dataset(path, analyzed_games_per_rating)
+        return
+    workers = workers or os.cpu_count() or 1
+    with Pool(workers) as pool:
+        rating_based_offsets = indexed_offsets(
+            path, analyzed_games_per_rating, max_analyzed_games, categories
+        )
+        if rating_based_offsets is None and compression(path) is not None:
+            # Byte ranges only split uncompressed files
+            with open_pgn(path) as pgn:
+                rating_based_offsets = load_offsets(
+                    pgn, analyzed_games_per_rating, max_analyzed_games, categories
+                )
+        elif rating_based_offsets is None:
+            rating_based_offsets = load_offsets_parallel(
+                path,
+                pool,
+                workers * 4,
+                analyzed_games_per_rating,
+                max_analyzed_games,
+                categories,
+            )
+        print("Loaded offsets")
+        for block_id, (rating_range, offsets) in enumerate(
+            rating_based_offsets.items()
+        ):
+            chunk_size = -(-len(offsets) // (workers * 4)) or 1
+            rating_moves: dict[str, list[str]] = {}
+            # Chunks are merged in file order, giving the same dict as load_dataset
+            for chunk_moves in pool.imap(
+                partial(load_offsets_moves, path),
+                [
+                    offsets[i : i + chunk_size]
+                    for i in range(0, len(offsets), chunk_size)
+                ],
+            ):
+                for fen, moves in chunk_moves.items():
+                    rating_moves.setdefault(fen, []).extend(moves)
+            print(
+                f"Loaded {len(offsets)} games from block {block_id}/{len(rating_based_offsets)}"
+            )
+            yield rating_range, rating_moves
 
 
 def dump_dataset(
@@ -114,10 +387,15 @@ def dump_dataset(
             yaml.safe_dump(moves, f)
 
 
-def main():
-    path = "./lichess_2022_02.pgn"
-    prefix = "lichess_2022_02_partition"
-    dataset = load_dataset(path)
+@click.command()
+@click.option("--path", default="./lichess_2022_02.pgn")
+@click.option("--prefix", default="lichess_2022_02_partition")
+@click.option("--workers", default=1)
+def main(path: str, prefix: str, workers: int):
+    if workers > 1:
+        dataset = load_dataset_parallel(path, workers=workers)
+    else:
+        dataset = load_dataset(path)
     dump_dataset(prefix, dataset)
 
 
@@ -0,0 +1,299 @@
+from dataclasses import dataclass, field
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+import os
+import queue
+import secrets
+import socket
+import stat
+import threading
+import time
+
+import chess
+import click
+import numpy as np
+
+from predict import Predictor
+from to_matrix import code_to_move, key_board, move_to_code, position_key
+
+DEFAULT_ADDRESS = "/tmp/chess-inference.sock"
+AUTHKEY_VARIABLE = "CHESS_INFERENCE_AUTHKEY"
+
+
+def default_authkey() -> bytes | None:
+    # Shared by the server and its clients, connections that don't know it
+    # are refused before anything is unpickled
+    authkey = os.environ.get(AUTHKEY_VARIABLE)
+    return authkey.encode() if authkey else None
+
+
+def server_running(address: str) -> bool:
+    # Whether something listens on the socket, a leftover file of a server
+    # that is gone refuses the connection
+    if not os.path.exists(address):
+        return False
+    if not stat.S_ISSOCK(os.stat(address).st_mode):
+        raise FileExistsError(f"{address} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX) as probe:
+        try:
+            probe.connect(address)
+        except ConnectionRefusedError:
+            return False
+    return True
+
+
+@dataclass
+class PendingRequest:
+    boards: list[chess.Board]
+    arrived: float = field(default_factory=time.monotonic)
+    done: threading.Event = field(default_factory=threading.Event)
+    result: list | None = None
+    error: str | None = None
+
+
+class ModelQueue:
+    # One model and the requests waiting for it. Requests are merged into a
+    # batch until it holds max_batch positions or the oldest one has waited
+    # max_latency seconds, then the batch runs in a single predict_many call.
+    def __init__(self, predictor: Predictor, max_batch: int, max_latency: float):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.requests: queue.Queue[PendingRequest] = queue.Queue()
+        self.n_batches = 0
+        self.n_positions = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def predict(self, boards: list[chess.Board]) -> PendingRequest:
+        request = PendingRequest(boards)
+        self.requests.put(request)
+        request.done.wait()
+        return request
+
+    def next_batch(self) -> list[PendingRequest]:
+        batch = [self.requests.get()]
+        n_positions = len(batch[0].boards)
+        deadline = batch[0].arrived + self.max_latency
+        while n_positions < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_positions += len(request.boards)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            boards = [board for request in batch for board in request.boards]
+            try:
+                predictions = self.predictor.predict_many(boards)
+            except Exception as error:
+                for request in batch:
+                    request.error = repr(error)
+                    request.done.set()
+                continue
+            self.n_batches += 1
+            self.n_positions += len(boards)
+            start = 0
+            for request in batch:
+                end = start + len(request.boards)
+                request.result = [
+                    pack_scores(scores) for scores in predictions[start:end]
+                ]
+                request.done.set()
+                start = end
+
+
+def pack_scores(scores: dict[chess.Move, float]) -> tuple[np.ndarray, np.ndarray]:
+    return (
+        np.array([move_to_code(move) for move in scores], dtype=np.uint16),
+        np.array(list(scores.values()), dtype=np.float32),
+    )
+
+
+def unpack_scores(packed: tuple[np.ndarray, np.ndarray]) -> dict[chess.Move, float]:
+    codes, scores = packed
+    return dict(zip(map(code_to_move, codes.tolist()), scores))
+
+
+class InferenceServer:
+    # Serves predictions for any number of checkpoints over a Unix socket,
+    # loading each checkpoint once on its first request
+    def __init__(
+        self,
+        address: str = DEFAULT_ADDRESS,
+        max_batch: int = 256,
+        max_latency: float = 0.005,
+        threads: int | None = None,
+        authkey: bytes | None = None,
+    ):
+        self.address = address
+        # Without a key given a random one is made, main() prints it
+        self.authkey = authkey or default_authkey() or secrets.token_hex(16).encode()
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.threads = threads
+        self.models: dict[str, ModelQueue] = {}
+        self.models_lock = threading.Lock()
+
+    def model(self, checkpoint: str | None) -> ModelQueue:
+        checkpoint = checkpoint and os.path.abspath(checkpoint)
+        with self.models_lock:
+            if checkpoint not in self.models:
+                self.models[checkpoint] = ModelQueue(
+                    Predictor(checkpoint, threads=self.threads),
+                    self.max_batch,
+                    self.max_latency,
+                )
+            return self.models[checkpoint]
+
+    def serve_client(self, connection: Connection):
+        # Requests are (checkpoint, position keys), answered with one (move
+        # codes, scores) pair per position or an error string
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    return
+                if request is None:
+                    return
+                checkpoint, keys = request
+                try:
+                    model = self.model(checkpoint)
+                except Exception as error:
+                    connection.send((None, repr(error)))
+                    continue
+                pending = model.predict([key_board(key) for key in keys])
+                connection.send((pending.result, pending.error))
+
+    def serve_forever(self):
+        if server_running(self.address):
+            raise RuntimeError(f"An inference server already listens on {self.address}")
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        with Listener(self.address, family="AF_UNIX", authkey=self.authkey) as listener:
+            os.chmod(self.address, 0o600)
+            try:
+                while True:
+                    try:
+                        connection = listener.accept()
+                    except (AuthenticationError, EOFError, ConnectionError):
+                        # A client without the key, or a server_running probe
+                        continue
+                    threading.Thread(
+                        target=self.serve_client, args=(connection,), daemon=True
+                    ).start()
+            finally:
+                if os.path.exists(self.address):
+                    os.unlink(self.address)
+
+
+class RemotePredictor:
+    # Same interface as Predictor, the predictions come from an
+    # InferenceServer. It connects on first use, so it can be pickled into
+    # worker processes and every process gets its own connection. The
+    # checkpoint path is made absolute, the server runs in another directory.
+    # Boards are sent as position keys, which keep the en passant square and
+    # move counters a default FEN drops. The move stack is not sent, the
+    # predictors only look at the position.
+    def __init__(
+        self,
+        checkpoint: str | None,
+        address: str = DEFAULT_ADDRESS,
+        authkey: bytes | None = None,
+    ):
+        self.checkpoint = checkpoint and os.path.abspath(checkpoint)
+        self.address = address
+        self.authkey = authkey or default_authkey()
+        if self.authkey is None:
+            raise ValueError(
+                f"No key for the inference server, set ${AUTHKEY_VARIABLE}"
+            )
+        self.connection: Connection | None = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        return {
+            "checkpoint": self.checkpoint,
+            "address": self.address,
+            "authkey": self.authkey,
+        }
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["checkpoint"], state["address"], state["authkey"])
+
+    def __call__(self, board: chess.Board) -> dict[chess.Move, float]:
+        return self.predict_many([board])[0]
+
+    def predict_many(self, boards: list[chess.Board]) -> list[dict[chess.Move, float]]:
+        with self.lock:
+            if self.connection is None:
+                self.connection = Client(
+                    self.address, family="AF_UNIX", authkey=self.authkey
+                )
+            self.connection.send(
+                (self.checkpoint, [position_key(board) for board in boards])
+            )
+            result, error = self.connection.recv()
+        if error is not None:
+            raise RuntimeError(f"Inference server error: {error}")
+        return [unpack_scores(packed) for packed in result]
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.send(None)
+                self.connection.close()
+                self.connection = None
+
+
+def make_predictor(
+    checkpoint: str, server: str | None = None
+) -> Predictor | RemotePredictor:
+    if server:
+        return RemotePredictor(checkpoint, server)
+    return Predictor(checkpoint)
+
+
+@click.command()
+@click.option("--address", default=DEFAULT_ADDRESS, help="Unix socket path")
+@click.option("--max-batch", default=256, help="Positions per forward pass")
+@click.option("--max-latency-ms", default=5.0, help="Longest wait to fill a batch")
+@click.option("--threads", default=None, type=int)
+@click.option("--preload", multiple=True, help="Checkpoints to load on start")
+@click.option(
+    "--authkey",
+    default=None,
+    help=f"Key the clients must know, ${AUTHKEY_VARIABLE} or a random one",
+)
+def main(
+    address: str,
+    max_batch: int,
+    max_latency_ms: float,
+    threads: int | None,
+    preload: list[str],
+    authkey: str | None,
+):
+    server = InferenceServer(
+        address,
+        max_batch,
+        max_latency_ms / 1000,
+        threads,
+        authkey and authkey.encode(),
+    )
+    for checkpoint in preload:
+        server.model(checkpoint)
+    if not authkey and default_authkey() is None:
+        print(f"export {AUTHKEY_VARIABLE}={server.authkey.decode()}")
+    print(f"Serving on {address}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+from dataclasses import dataclass, field
+import math
+from multiprocessing import Pool
+import os
+import random
+import time
+
+import chess
+import chess.pgn
+import click
+import torch
+
+from inference_server import RemotePredictor, make_predictor
+from predict import Predictor
+from prediction_cache import CachedPredictor
+from search_tree import SearchTree, predict_batch
+
+# Loaded once per worker process by load_players
+PLAYERS: dict[str, Predictor | RemotePredictor | CachedPredictor] = {}
+
+
+@dataclass
+class GameSpec:
+    index: int
+    opening: str
+    # Whether the first checkpoint plays white
+    a_white: bool
+
+
+@dataclass
+class MatchGame:
+    spec: GameSpec
+    board: chess.Board
+    trees: dict[bool, SearchTree | None] = field(
+        default_factory=lambda: {chess.WHITE: None, chess.BLACK: None}
+    )
+    target: int = 0
+
+    def player(self) -> str:
+        return "a" if (self.board.turn == chess.WHITE) == self.spec.a_white else "b"
+
+    def tree(self, nodes: int) -> SearchTree:
+        # The tree of the side to move, re-rooted on the current position or
+        # rebuilt, with the node count to reach for this move
+        tree = self.trees[self.board.turn]
+        if tree is None or not tree.advance(self.board):
+            tree = SearchTree(self.board, PLAYERS[self.player()])
+            self.trees[self.board.turn] = tree
+            self.target = 0
+        if not self.target:
+            self.target = tree.n_explored() + nodes
+        return tree
+
+    def play_best_move(self, tree: SearchTree):
+        values = tree.root_values()
+        self.target = 0
+        if values:
+            self.board.push(max(values, key=values.get))
+
+    def result(self, max_plies: int) -> str | None:
+        if self.board.is_game_over(claim_draw=True):
+            return self.board.result(claim_draw=True)
+        if len(self.board.move_stack) >= max_plies:
+            return "1/2-1/2"
+        return None
+
+
+def load_players(
+    checkpoint_a: str,
+    checkpoint_b: str,
+    threads: int,
+    server: str | None = None,
+    cache: bool = False,
+):
+    # With cache every worker keeps the predictions of its own games, the
+    # two colors of an opening are played by the same worker
+    torch.set_num_threads(threads)
+    PLAYERS["a"] = make_predictor(checkpoint_a, server)
+    PLAYERS["b"] = (
+        PLAYERS["a"]
+        if checkpoint_b == checkpoint_a
+        else make_predictor(checkpoint_b, server)
+    )
+    if cache:
+        shared = PLAYERS["a"] is PLAYERS["b"]
+        PLAYERS["a"] = CachedPredictor(PLAYERS["a"])
+        PLAYERS["b"] = PLAYERS["a"] if shared else CachedPredictor(PLAYERS["b"])
+
+
+def opening_board(opening: str) -> chess.Board:
+    # A FEN, or space separated UCI moves from the starting position
+    try:
+        return chess.Board(opening)
+    except ValueError:
+        board = chess.Board()
+        for move in opening.split():
+            board.push_uci(move)
+        return board
+
+
+def play_games(
+    specs: list[GameSpec],
+    nodes: int,
+    batch_size: int,
+    max_plies: int,
+    names: tuple[str, str],
+) -> list[tuple[int, float, str]]:
+    # Plays the games side by side. Every step selects a batch of leaves in
+    # the tree of each game, then each checkpoint predicts the leaves of all
+    # its games in one call. Returns (index, score of a, PGN) per game.
+    games = [MatchGame(spec, opening_board(spec.opening)) for spec in specs]
+    shared = PLAYERS["a"] is PLAYERS["b"]
+    finished = []
+    while games:
+        # Finished games leave before searching, an opening can already be
+        # over and its root has no moves
+        for game in list(games):
+            result = game.result(max_plies)
+            if result is None:
+                continue
+            games.remove(game)
+            finished.append(record_game(game, result, names))
+        requests: dict[str, list] = {"a": [], "b": []}
+        for game in games:
+            tree = game.tree(nodes)
+            leaves, boards = tree.select_batch(batch_size)
+            if leaves:
+                player = "a" if shared else game.player()
+                requests[player].append((game, tree, leaves, boards))
+            else:
+                # Only game over or pending leaves left to search
+                game.play_best_move(tree)
+        for player, items in requests.items():
+            boards = [board for *_, item_boards in items for board in item_boards]
+            if not boards:
+                continue
+            predictions = predict_batch(PLAYERS[player], boards)
+            start = 0
+            for game, tree, leaves, item_boards in items:
+                end = start + len(item_boards)
+                tree.expand_leaves(leaves, item_boards, predictions[start:end])
+                start = end
+                if tree.n_explored() >= game.target:
+                    game.play_best_move(tree)
+    return finished
+
+
+def record_game(
+    game: MatchGame, result: str, names: tuple[str, str]
+) -> tuple[int, float, str]:
+    pgn = chess.pgn.Game.from_board(game.board)
+    white, black = names if game.spec.a_white else names[::-1]
+    pgn.headers["Event"] = f"{names[0]} vs {names[1]}"
+    pgn.headers["Round"] = str(game.spec.index + 1)
+    pgn.headers["White"] = white
+    pgn.headers["Black"] = black
+    pgn.headers["Result"] = result
+    white_score = {"1-0": 1.0, "0-1": 0.0}.get(result, 0.5)
+    score = white_score if game.spec.a_white else 1 - white_score
+    return game.spec.index, score, str(pgn)
+
+
+def play_games_task(args) -> list[tuple[int, float, str]]:
+    return play_games(*args)
+
+
+def game_specs(
+    n_games: int, openings: list[str], random_plies: int, seed: int
+) -> list[GameSpec]:
+    # Every opening is played twice with the colors swapped. Without an
+    # openings file they are random moves from the starting position.
+    rng = random.Random(seed)
+    openings = list(openings)
+    rng.shuffle(openings)
+    specs = []
+    for i in range(-(-n_games // 2)):
+        if openings:
+            opening = openings[i % len(openings)]
+        else:
+            board = chess.Board()
+            for _ in range(random_plies):
+                if board.is_game_over():
+                    break
+                board.push(rng.choice(list(board.legal_moves)))
+            opening = board.fen()
+        specs += [GameSpec(2 * i, opening, True), GameSpec(2 * i + 1, opening, False)]
+    return specs[:n_games]
+
+
+def elo_estimate(scores: list[float]) -> tuple[float, float]:
+    # Elo difference of a over b and the half width of its 95% interval
+    n = len(scores)
+    mean = sum(scores) / n
+    deviation = math.sqrt(sum((s - mean) ** 2 for s in scores) / n / n)
+
+    def elo(score: float) -> float:
+        score = min(max(score, 1e-3), 1 - 1e-3)
+        return -400 * math.log10(1 / score - 1)
+
+    return elo(mean), (elo(mean + 1.96 * deviation) - elo(mean - 1.96 * deviation)) / 2
+
+
+@click.command()
+@click.argument("checkpoint_a")
+@click.argument("checkpoint_b")
+@click.option("--games", "n_games", default=100)
+@click.option("--openings", default=None, help="File with one FEN or UCI line each")
+@click.option("--random-plies", default=6, help="Random opening moves otherwise")
+@click.option("--nodes", default=400, help="Explored leaves per move")
+@click.option("--batch-size", default=8, help="Leaves per game and step")
+@click.option("--concurrency", default=32, help="Games played side by side")
+@click.option("--workers", default=os.cpu_count() or 1)
+@click.option("--threads", default=1, help="Torch threads per worker")
+@click.option("--max-plies", default=400)
+@click.option("--output", default="match.pgn")
+@click.option("--seed", default=0)
+@click.option(
+    "--server",
+    default=None,
+    help="Inference server socket to predict on, with $CHESS_INFERENCE_AUTHKEY",
+)
+@click.option("--cache", is_flag=True, help="Cache the evaluations in every worker")
+def main(
+    checkpoint_a: str,
+    checkpoint_b: str,
+    n_games: int,
+    openings: str | None,
+    random_plies: int,
+    nodes: int,
+    batch_size: int,
+    concurrency: int,
+    workers: int,
+    threads: int,
+    max_plies: int,
+    output: str,
+    seed: int,
+    server: str | None,
+    cache: bool,
+):
+    opening_lines = []
+    if openings:
+        with open(openings, encoding="utf-8") as file:
+            opening_lines = [line.strip() for line in file if line.strip()]
+    specs = game_specs(n_games, opening_lines, random_plies, seed)
+    names = (os.path.basename(checkpoint_a), os.path.basename(checkpoint_b))
+    # Each task is one group of games played side by side, small enough to
+    # keep every worker busy, with both colors of an opening together
+    group_size = min(concurrency, -(-len(specs) // workers))
+    group_size += group_size % 2
+    tasks = [
+        (specs[i : i + group_size], nodes, batch_size, max_plies, names)
+        for i in range(0, len(specs), group_size)
+    ]
+    scores: list[float] = []
+    start = time.monotonic()
+    with Pool(
+        workers, load_players, (checkpoint_a, checkpoint_b, threads, server, cache)
+    ) as pool, open(output, "a", encoding="utf-8") as pgn_file:
+        for results in pool.imap_unordered(play_games_task, tasks):
+            for _index, score, pgn in sorted(results):
+                pgn_file.write(pgn + "\n\n")
+                scores.append(score)
+            pgn_file.flush()
+            elo, margin = elo_estimate(scores)
+            hours = (time.monotonic() - start) / 3600
+            print(
+                f"{len(scores)}/{len(specs)} games:",
+                f"+{scores.count(1.0)} ={scores.count(0.5)} -{scores.count(0.0)},",
+                f"score {sum(scores) / len(scores):.3f},",
+                f"Elo {elo:+.0f} ± {margin:.0f},",
+                f"{len(scores) / hours:.0f} games/hour",
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
-import matplotlib.pyplot as plt
+import click
+import numpy as np
 import torch
 
-import to_matrix
+import binary_dataset
+from to_matrix import POLICY_PLANES, POLICY_SIZE
 
 
 class Thinker(torch.nn.Module):
@@ -47,35 +49,203 @@ class Network(torch.nn.Module):
         return self.chess_move_quality_predictor(x)
 
 
-def train():
-    dataset = to_matrix.strategies_from_file("fens.yaml", 200000)
-    network = Network()
-    optimizer = torch.optim.Adam(network.parameters(), lr=0.01)
-    print(f"Num params: {sum(p.numel() for p in network.parameters())}")
-    loss_function = torch.nn.MSELoss()
-    all_moves = list(dataset)
-    print(f"Loaded {len(all_moves)} moves")
-    all_board_and_moves = torch.Tensor(
-        [strategy.board_and_move for strategy in all_moves]
-    )
-    all_ratings = torch.Tensor([[move.rating, 1 - move.rating] for move in all_moves])
-    losses = []
-    for epoch in range(1000):
-        optimizer.zero_grad()
-        output = network(all_board_and_moves)
-        loss = loss_function(output, all_ratings)
-        print(
-            f"Loss: {loss} after epoch {epoch}; example output: {output[0]}, target: {all_ratings[0]}"
+class PolicyNetwork(torch.nn.Module):
+    # Scores every move of a position in one pass: the trunk only sees the
+    # board, the from/to logits are the dot products of per-square "from"
+    # and "to" embeddings and the under-promotions get their own head. The
+    # outputs are indexed by to_matrix.codes_to_policy_indices.
+    def __init__(self, n_filters=32, n_hidden=3, embedding_size=16):
+        super().__init__()
+        self.trunk = torch.nn.Sequential(
+            torch.nn.Conv2d(POLICY_PLANES, n_filters, 3, padding="same"),
+            torch.nn.ReLU(),
+            *[
+                torch.nn.Sequential(
+                    torch.nn.Conv2d(n_filters, n_filters, 3, padding="same"),
+                    torch.nn.ReLU(),
+                )
+                for _ in range(n_hidden)
+            ],
+        )
+        self.from_head = torch.nn.Conv2d(n_filters, embedding_size, 1)
+        self.to_head = torch.nn.Conv2d(n_filters, embedding_size, 1)
+        self.promotion_head = torch.nn.Sequential(
+            torch.nn.Conv2d(n_filters, 2, 1),
+            torch.nn.ReLU(),
+            torch.nn.Flatten(),
+            torch.nn.Linear(2 * 64, POLICY_SIZE - 64 * 64),
+        )
+        self.scale = embedding_size**-0.5
+
+    def forward(self, x):
+        features = self.trunk(x)
+        from_embeddings = self.from_head(features).flatten(2)
+        to_embeddings = self.to_head(features).flatten(2)
+        moves = torch.einsum("bef,bet->bft", from_embeddings, to_embeddings)
+        return torch.cat(
+            [moves.flatten(1) * self.scale, self.promotion_head(features)], dim=1
+        )
+
+
+def is_policy_state_dict(state_dict: dict) -> bool:
+    return any(key.startswith("trunk.") for key in state_dict)
+
+
+def policy_loss(
+    logits: torch.Tensor, targets: torch.Tensor, legal: torch.Tensor
+) -> torch.Tensor:
+    # Cross-entropy against the move frequencies, over the legal moves only
+    log_probabilities = torch.log_softmax(logits.masked_fill(~legal, -1e9), dim=1)
+    return -(targets * log_probabilities).sum(dim=1).mean()
+
+
+class StrategyBatches(torch.utils.data.IterableDataset):
+    # Mini-batches of `positions_per_batch` positions from a binary dataset,
+    # each loader worker reading its own part of the shuffled positions
+    def __init__(
+        self,
+        prefix: str,
+        positions_per_batch: int = 256,
+        seed: int = 0,
+        part: int = 0,
+        n_parts: int = 1,
+    ):
+        super().__init__()
+        self.prefix = prefix
+        self.positions_per_batch = positions_per_batch
+        self.seed = seed
+        self.part = part
+        self.n_parts = n_parts
+        self.epoch = 0
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (
+            (0, 1) if worker is None else (worker.id, worker.num_workers)
         )
-        losses.append(loss.item())
-        loss.backward()
-        optimizer.step()
+        # The memory maps are opened in the worker rather than pickled into it
+        dataset = binary_dataset.BinaryDataset(self.prefix)
+        for board_and_moves, ratings in dataset.batches(
+            self.positions_per_batch,
+            seed=self.seed + self.epoch,
+            part=self.part * n_workers + worker_id,
+            n_parts=self.n_parts * n_workers,
+        ):
+            yield torch.from_numpy(board_and_moves), torch.from_numpy(
+                np.stack([ratings, 1 - ratings], axis=1)
+            )
+
+
+class PolicyBatches(StrategyBatches):
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (
+            (0, 1) if worker is None else (worker.id, worker.num_workers)
+        )
+        dataset = binary_dataset.BinaryDataset(self.prefix)
+        for planes, targets, legal in dataset.policy_batches(
+            self.positions_per_batch,
+            seed=self.seed + self.epoch,
+            part=self.part * n_workers + worker_id,
+            n_parts=self.n_parts * n_workers,
+        ):
+            yield torch.from_numpy(planes), (
+                torch.from_numpy(targets),
+                torch.from_numpy(legal),
+            )
+
+
+def strategy_loader(
+    dataset: StrategyBatches, workers: int
+) -> torch.utils.data.DataLoader:
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=workers,
+        pin_memory=torch.cuda.is_available(),
+        prefetch_factor=4 if workers else None,
+    )
+
+
+def train(
+    prefix: str = "fens",
+    batch_size: int = 256,
+    epochs: int = 1000,
+    checkpoint_interval: int = 100,
+    workers: int = 4,
+    checkpoint_prefix: str = "network_3",
+    log_path: str = "losses.csv",
+    policy: bool = False,
+):
+    if policy:
+        dataset = PolicyBatches(prefix, batch_size)
+        network = PolicyNetwork()
+        optimizer = torch.optim.Adam(network.parameters(), lr=0.001)
+
+        def loss_function(logits, targets):
+            return policy_loss(logits, *targets)
+
+    else:
+        dataset = StrategyBatches(prefix, batch_size)
+        network = Network()
+        optimizer = torch.optim.Adam(network.parameters(), lr=0.01)
+        loss_function = torch.nn.MSELoss()
+    loader = strategy_loader(dataset, workers)
+    print(f"Num params: {sum(p.numel() for p in network.parameters())}")
+    with open(log_path, "a", encoding="utf-8") as log:
+        for epoch in range(epochs):
+            dataset.epoch = epoch
+            losses = []
+            for step, (board_and_moves, ratings) in enumerate(loader):
+                optimizer.zero_grad()
+                output = network(board_and_moves)
+                loss = loss_function(output, ratings)
+                loss.backward()
+                optimizer.step()
+                losses.append(loss.item())
+                log.write(f"{epoch},{step},{losses[-1]}\n")
+            log.flush()
+            print(
+                f"Loss: {sum(losses) / max(len(losses), 1)} after epoch {epoch}",
+                f"({len(losses)} batches)",
+            )
+
+            if not epoch % checkpoint_interval:
+                torch.save(
+                    network.state_dict(), f"{checkpoint_prefix}_epoch_{epoch}.pt"
+                )
 
-        if not epoch % 100:
-            torch.save(network.state_dict(), f"network_3_epoch_{epoch}.pt")
-            plt.plot(losses)
-            plt.show()
+
+@click.command()
+@click.option("--data", default="fens", help="Prefix of the binary dataset shards")
+@click.option("--batch-size", default=256, help="Positions per mini-batch")
+@click.option("--epochs", default=1000)
+@click.option("--checkpoint-interval", default=100)
+@click.option("--workers", default=4)
+@click.option("--checkpoint-prefix", default="network_3")
+@click.option("--log", "log_path", default="losses.csv")
+@click.option("--policy", is_flag=True, help="Train a PolicyNetwork")
+def main(
+    data: str,
+    batch_size: int,
+    epochs: int,
+    checkpoint_interval: int,
+    workers: int,
+    checkpoint_prefix: str,
+    log_path: str,
+    policy: bool,
+):
+    train(
+        data,
+        batch_size,
+        epochs,
+        checkpoint_interval,
+        workers,
+        checkpoint_prefix,
+        log_path,
+        policy,
+    )
 
 
 if __name__ == "__main__":
-    train()
+    main()
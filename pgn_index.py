@@ -0,0 +1,191 @@
+import os
+import re
+
+import click
+import numpy as np
+
+from pgn_io import open_pgn
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("offset", "<u8"),
+        ("length", "<u4"),
+        # -1 when the rating is missing or not a number
+        ("white_elo", "<i2"),
+        ("black_elo", "<i2"),
+        # 1 for a white win, -1 for a black win, 0 for a draw, -2 if unknown
+        ("result", "i1"),
+        ("plies", "<u2"),
+        # Base time and increment in seconds, -1 for "-" or a missing tag
+        ("base_time", "<i4"),
+        ("increment", "<i2"),
+    ]
+)
+RESULTS = {"1-0": 1, "0-1": -1, "1/2-1/2": 0}
+TAG_RE = re.compile(rb'^\[(\w+)\s+"(.*)"\]')
+TOKEN_RE = re.compile(rb"[{}()]|[^\s{}()]+")
+MOVE_NUMBER_RE = re.compile(rb"^\d+\.+")
+SAN_RE = re.compile(
+    rb"^([NBRQK]?[a-h]?[1-8]?x?[a-h][1-8](=?[NBRQ])?|O-O(-O)?)[+#]?[!?]*$"
+)
+
+
+def index_path(pgn_path: str) -> str:
+    return f"{pgn_path}.idx.npy"
+
+
+def parse_elo(value: bytes | None) -> int:
+    if not value or not value.isdigit():
+        return -1
+    return min(int(value), np.iinfo(np.int16).max)
+
+
+def parse_time_control(value: bytes | None) -> tuple[int, int]:
+    match = re.fullmatch(rb"(\d+)(?:\+(\d+))?", value or b"")
+    if match is None:
+        return -1, -1
+    return int(match[1]), int(match[2] or 0)
+
+
+def game_record(offset: int, length: int, tags: dict[bytes, bytes], plies: int):
+    return (
+        offset,
+        length,
+        parse_elo(tags.get(b"WhiteElo")),
+        parse_elo(tags.get(b"BlackElo")),
+        RESULTS.get(tags.get(b"Result", b"").decode(errors="replace"), -2),
+        min(plies, np.iinfo(np.uint16).max),
+        *parse_time_control(tags.get(b"TimeControl")),
+    )
+
+
+def build_index(pgn_path: str) -> np.ndarray:
+    # One pass over the raw bytes: tag pairs are parsed, the mainline plies
+    # are counted from the movetext outside of comments and variations
+    records = []
+    offset = None
+    tags: dict[bytes, bytes] = {}
+    plies = 0
+    depth = 0
+    in_movetext = False
+    with open_pgn(pgn_path, binary=True) as pgn:
+        position = 0
+        for line in iter(pgn.readline, b""):
+            if depth == 0 and line.startswith(b"["):
+                if (
+                    offset is None
+                    or in_movetext
+                    or (line.startswith(b"[Event ") and b"Event" in tags)
+                ):
+                    if offset is not None:
+                        records.append(
+                            game_record(offset, position - offset, tags, plies)
+                        )
+                    offset, tags, plies, in_movetext = position, {}, 0, False
+                match = TAG_RE.match(line)
+                if match:
+                    tags[match[1]] = match[2]
+            elif offset is not None and line.strip():
+                in_movetext = True
+                for token in TOKEN_RE.findall(line):
+                    if token in (b"{", b"("):
+                        depth += 1
+                    elif token in (b"}", b")"):
+                        depth = max(depth - 1, 0)
+                    elif depth == 0 and SAN_RE.match(MOVE_NUMBER_RE.sub(b"", token)):
+                        plies += 1
+            position += len(line)
+        if offset is not None:
+            records.append(game_record(offset, position - offset, tags, plies))
+    index = np.array(records, dtype=INDEX_DTYPE)
+    np.save(index_path(pgn_path), index)
+    return index
+
+
+class GameIndex:
+    def __init__(self, games: np.ndarray):
+        self.games = games
+
+    @classmethod
+    def open(cls, pgn_path: str, rebuild: bool = False) -> "GameIndex":
+        # Reuses the sidecar file unless the PGN file changed after it
+        path = index_path(pgn_path)
+        if (
+            rebuild
+            or not os.path.exists(path)
+            or os.path.getmtime(path) < os.path.getmtime(pgn_path)
+        ):
+            build_index(pgn_path)
+        return cls(np.load(path, mmap_mode="r"))
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+    def mask(
+        self,
+        min_elo: int | None = None,
+        max_elo: int | None = None,
+        both: bool = True,
+        min_plies: int | None = None,
+        base_time: int | None = None,
+        increment: int | None = None,
+        results: list[int] | None = None,
+    ) -> np.ndarray:
+        # The Elo bounds apply to both players, or to at least one with
+        # both=False; games without numeric ratings never match them
+        mask = np.ones(len(self.games), dtype=bool)
+        if min_elo is not None or max_elo is not None:
+            elos = np.stack([self.games["white_elo"], self.games["black_elo"]])
+            in_range = elos >= max(min_elo or 0, 0)
+            if max_elo is not None:
+                in_range &= elos <= max_elo
+            mask &= in_range.all(axis=0) if both else in_range.any(axis=0)
+        if min_plies is not None:
+            mask &= self.games["plies"] >= min_plies
+        if base_time is not None:
+            mask &= self.games["base_time"] == base_time
+        if increment is not None:
+            mask &= self.games["increment"] == increment
+        if results is not None:
+            mask &= np.isin(self.games["result"], results)
+        return mask
+
+    def select(self, **filters) -> np.ndarray:
+        return self.games["offset"][self.mask(**filters)]
+
+    def rating_buckets(
+        self,
+        analyzed_games_per_rating: int,
+        max_analyzed_games: int,
+        categories: list[int],
+    ) -> dict[tuple[int, int], list[int]]:
+        # Same selection as generate_dataset.load_offsets
+        valid = np.flatnonzero(
+            (self.games["white_elo"] >= 0) & (self.games["black_elo"] >= 0)
+        )[:max_analyzed_games]
+        white = self.games["white_elo"][valid]
+        black = self.games["black_elo"][valid]
+        unassigned = np.ones(len(valid), dtype=bool)
+        buckets = {}
+        for low, high in zip([0] + categories, categories):
+            matches = unassigned & (
+                ((low <= white) & (white <= high)) | ((low <= black) & (black <= high))
+            )
+            unassigned &= ~matches
+            buckets[(low, high)] = (
+                self.games["offset"][valid[matches][:analyzed_games_per_rating]]
+                .astype(int)
+                .tolist()
+            )
+        return buckets
+
+
+@click.command()
+@click.argument("pgn_path")
+def main(pgn_path: str):
+    index = GameIndex.open(pgn_path, rebuild=True)
+    print(f"Indexed {len(index)} games into {index_path(pgn_path)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import bisect
+import bz2
+import lzma
+import os
+import queue
+import threading
+from typing import IO, Callable
+
+import click
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1 << 20
+FRAME_SIZE = 16 << 20
+# (compressed offset, decompressed offset) of every frame start
+FRAMES_DTYPE = np.dtype([("compressed", "<u8"), ("decompressed", "<u8")])
+
+
+def compression(path: str) -> str | None:
+    for suffix in ("bz2", "xz", "zst"):
+        if path.endswith(f".{suffix}"):
+            return suffix
+    return None
+
+
+def new_decompressor(kind: str):
+    if kind == "bz2":
+        return bz2.BZ2Decompressor()
+    if kind == "xz":
+        return lzma.LZMADecompressor()
+    if zstandard is None:
+        raise ImportError("Reading .zst files needs the zstandard package")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def compress_frame(kind: str, data: bytes, level: int | None = None) -> bytes:
+    if kind == "bz2":
+        return bz2.compress(data, level or 9)
+    if kind == "xz":
+        return lzma.compress(data, preset=level)
+    if zstandard is None:
+        raise ImportError("Writing .zst files needs the zstandard package")
+    return zstandard.ZstdCompressor(level=level or 10).compress(data)
+
+
+def frames_path(path: str) -> str:
+    return f"{path}.frames.npy"
+
+
+class DecompressedPGN:
+    # Reads a bz2, xz or zstd file as a stream, with the decompression running
+    # on a background thread one bounded queue of chunks ahead of the parser.
+    # tell() and seek() use decompressed byte offsets, the same ones as on the
+    # uncompressed file. Every frame (a bz2/xz stream or zstd frame) can be
+    # decompressed on its own, so a seek starts from the last frame before
+    # the target; the frame starts are saved next to the file after a full
+    # pass. Single-frame files can only seek forward cheaply, see reframe.
+    def __init__(
+        self,
+        path: str,
+        binary: bool = False,
+        chunk_size: int = CHUNK_SIZE,
+        prefetch: int = 8,
+    ):
+        self.path = path
+        self.kind = compression(path)
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.frames: dict[int, int] = {0: 0}
+        self.frame_starts = [0]
+        self.frames_lock = threading.Lock()
+        if os.path.exists(frames_path(path)) and os.path.getmtime(
+            frames_path(path)
+        ) >= os.path.getmtime(path):
+            for compressed, decompressed in np.load(frames_path(path)).tolist():
+                self.add_frame(compressed, decompressed)
+        self.thread: threading.Thread | None = None
+        self.restart(0)
+
+    def add_frame(self, compressed: int, decompressed: int):
+        with self.frames_lock:
+            if decompressed not in self.frames:
+                self.frames[decompressed] = compressed
+                bisect.insort(self.frame_starts, decompressed)
+
+    def restart(self, decompressed: int):
+        self.stop_thread()
+        self.buffer = b""
+        self.buffer_start = decompressed
+        self.cursor = 0
+        self.finished = False
+        self.stopped = threading.Event()
+        self.chunks: queue.Queue = queue.Queue(self.prefetch)
+        self.thread = threading.Thread(
+            target=self.decompress,
+            args=(self.frames[decompressed], decompressed, self.chunks, self.stopped),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop_thread(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def decompress(
+        self,
+        compressed: int,
+        decompressed: int,
+        chunks: queue.Queue,
+        stopped: threading.Event,
+    ):
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        with open(self.path, "rb") as file:
+            file.seek(compressed)
+            decompressor = new_decompressor(self.kind)
+            while data := file.read(self.chunk_size):
+                end = file.tell()
+                while data:
+                    output = decompressor.decompress(data)
+                    decompressed += len(output)
+                    if output and not put(output):
+                        return
+                    if not decompressor.eof:
+                        break
+                    # The rest of the chunk belongs to the next frame
+                    data = decompressor.unused_data
+                    self.add_frame(end - len(data), decompressed)
+                    decompressor = new_decompressor(self.kind)
+        put(None)
+
+    def fill(self) -> bool:
+        # Appends the next chunk to the unread part of the buffer
+        if self.finished:
+            return False
+        chunk = self.chunks.get()
+        if chunk is None:
+            self.finished = True
+            self.save_frames()
+            return False
+        self.buffer_start += self.cursor
+        self.buffer = self.buffer[self.cursor :] + chunk
+        self.cursor = 0
+        return True
+
+    def save_frames(self):
+        path = frames_path(self.path)
+        if len(self.frames) > 2 and not (
+            os.path.exists(path)
+            and os.path.getmtime(path) >= os.path.getmtime(self.path)
+        ):
+            np.save(path, np.array(sorted(self.frames.items()), FRAMES_DTYPE))
+
+    def readline(self) -> str | bytes:
+        while (end := self.buffer.find(b"\n", self.cursor)) < 0 and self.fill():
+            pass
+        end = len(self.buffer) if end < 0 else end + 1
+        line = self.buffer[self.cursor : end]
+        self.cursor = end
+        return line if self.binary else line.decode("utf-8", errors="replace")
+
+    def __iter__(self):
+        return iter(self.readline, b"" if self.binary else "")
+
+    def tell(self) -> int:
+        return self.buffer_start + self.cursor
+
+    def seek(self, offset: int):
+        with self.frames_lock:
+            frame = self.frame_starts[
+                bisect.bisect_right(self.frame_starts, offset) - 1
+            ]
+        if not frame <= self.buffer_start <= offset:
+            self.restart(frame)
+        # Decompresses forward up to the offset
+        while self.buffer_start + len(self.buffer) < offset and self.fill():
+            self.cursor = len(self.buffer)
+        self.cursor = min(offset - self.buffer_start, len(self.buffer))
+
+    def close(self):
+        self.stop_thread()
+
+    def __enter__(self) -> "DecompressedPGN":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_pgn(path: str, binary: bool = False) -> IO | DecompressedPGN:
+    if compression(path) is None:
+        return open(path, "rb" if binary else "r")
+    return DecompressedPGN(path, binary)
+
+
+def reframe(
+    source: str,
+    destination: str,
+    frame_size: int = FRAME_SIZE,
+    level: int | None = None,
+    progress: Callable[[int], None] | None = None,
+) -> int:
+    # Recompresses a PGN file (compressed or not) as independent frames of
+    # about frame_size decompressed bytes, each starting at an "[Event" line,
+    # so any game offset can be read by decompressing at most one frame
+    kind = compression(destination)
+    if kind is None:
+        raise ValueError(f"{destination} should end with .bz2, .xz or .zst")
+    frames = []
+    compressed = 0
+    decompressed = 0
+    lines: list[bytes] = []
+    n_bytes = 0
+    with open_pgn(source, binary=True) as pgn, open(destination, "wb") as output:
+        for line in pgn:
+            if n_bytes >= frame_size and line.startswith(b"[Event "):
+                frames.append((compressed, decompressed))
+                compressed += output.write(compress_frame(kind, b"".join(lines), level))
+                decompressed += n_bytes
+                lines, n_bytes = [], 0
+                if progress:
+                    progress(decompressed)
+            lines.append(line)
+            n_bytes += len(line)
+        if lines:
+            frames.append((compressed, decompressed))
+            output.write(compress_frame(kind, b"".join(lines), level))
+    np.save(frames_path(destination), np.array(frames, FRAMES_DTYPE))
+    return len(frames)
+
+
+@click.command()
+@click.argument("source")
+@click.argument("destination")
+@click.option("--frame-mb", default=16, help="Decompressed size of each frame")
+@click.option("--level", default=None, type=int)
+def main(source: str, destination: str, frame_mb: int, level: int | None):
+    n_frames = reframe(
+        source,
+        destination,
+        frame_mb << 20,
+        level,
+        lambda n: print(f"{n >> 20} MiB written", end="\r"),
+    )
+    print(f"Wrote {n_frames} frames into {destination}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,12 @@ import glob
 
 import chess
 import chess.pgn
+import click
 
-from amplify import amplify
-from predict import predict
+from amplify import make_searcher
+from predict import Predictor
+from prediction_cache import cache_session
+from search_stats import write_json_line
 
 
 def rerank_with_repetition(b, moves):
@@ -18,31 +21,55 @@ def rerank_with_repetition(b, moves):
     return moves
 
 
-def play():
-    # An AI vs AI game
+def play(
+    checkpoint: str,
+    workers: int = 1,
+    stats_log: str | None = None,
+    cache: bool = False,
+    cache_file: str | None = None,
+):
+    # An AI vs AI game. With stats_log, the stats of every search are
+    # appended to that file as JSON lines. With workers every process keeps
+    # its own cache, only what was loaded from cache_file is shared.
     b = chess.Board()
-    try:
-        while (
-            not b.is_checkmate()
-            and not b.is_stalemate()
-            and not b.is_insufficient_material()
-        ):
-            print(b)
-            print()
-            moves = rerank_with_repetition(b, amplify(b, predict, 1000))
-            for move, _rating in sorted(
-                moves.items(), key=lambda x: x[1], reverse=True
+    with cache_session(Predictor(checkpoint), cache, cache_file) as predict:
+        searcher = make_searcher(
+            predict, 1000, workers=workers, collect_stats=bool(stats_log)
+        )
+        log = open(stats_log, "a", encoding="utf-8") if stats_log else None
+        try:
+            while (
+                not b.is_checkmate()
+                and not b.is_stalemate()
+                and not b.is_insufficient_material()
             ):
-                b.push(move)
-                if b.is_repetition(7):
-                    b.pop()
-                    continue
-                break
-            else:
-                print("No more non-repeating moves")
-                break
-    except KeyboardInterrupt:
-        pass
+                print(b)
+                print()
+                fen = b.fen()
+                moves = rerank_with_repetition(b, searcher(b))
+                for move, _rating in sorted(
+                    moves.items(), key=lambda x: x[1], reverse=True
+                ):
+                    b.push(move)
+                    if b.is_repetition(7):
+                        b.pop()
+                        continue
+                    break
+                else:
+                    print("No more non-repeating moves")
+                    break
+                if log:
+                    write_json_line(
+                        log,
+                        {"ply": b.ply() - 1, "fen": fen, "move": b.peek().uci()}
+                        | searcher.stats.to_dict(),
+                    )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            searcher.close()
+            if log:
+                log.close()
 
     # Save game history as pgn
     pgn = chess.pgn.Game.from_board(b)
@@ -55,5 +82,25 @@ def play():
         print(f"Game saved as game{i}.pgn")
 
 
+@click.command()
+@click.option("--checkpoint", default="network_9.pt")
+@click.option(
+    "--workers", default=1, help="Search processes, they split the node budget"
+)
+@click.option("--stats-log", default=None, help="JSON lines file for search stats")
+@click.option("--cache", is_flag=True, help="Cache the evaluations of positions")
+@click.option(
+    "--cache-file", default=None, help="Load the cache from and save it to this file"
+)
+def main(
+    checkpoint: str,
+    workers: int,
+    stats_log: str | None,
+    cache: bool,
+    cache_file: str | None,
+):
+    play(checkpoint, workers, stats_log, cache, cache_file)
+
+
 if __name__ == "__main__":
-    play()
+    main()
@@ -2,29 +2,47 @@ import chess
 import chess.pgn
 import click
 
-from amplify import amplified_predictor
+from amplify import make_searcher
 from predict import Predictor
+from prediction_cache import cache_session
+from search_stats import write_json_line
 
 
-def play_against_ai(checkpoint: str):
+def play_against_ai(
+    checkpoint: str,
+    workers: int = 1,
+    stats_log: str | None = None,
+    cache: bool = False,
+    cache_file: str | None = None,
+):
     board = chess.Board()
-    w_predictor = Predictor(checkpoint)
-    predictor = amplified_predictor(w_predictor, 1000)
-    while not board.is_game_over():
-        if board.turn == chess.WHITE:
-            print(board)
-            while True:
-                try:
-                    move = input("Enter your move: ")
-                    board.push_san(move)
-                    break
-                except ValueError:
-                    print("Invalid move")
-        else:
-            moves = predictor(board)
-            move = max(moves, key=lambda x: moves[x])
-            print("AI move: ", move)
-            board.push(move)
+    with cache_session(
+        Predictor(checkpoint), cache, cache_file
+    ) as w_predictor, make_searcher(
+        w_predictor, 1000, workers=workers, collect_stats=bool(stats_log)
+    ) as predictor:
+        while not board.is_game_over():
+            if board.turn == chess.WHITE:
+                print(board)
+                while True:
+                    try:
+                        move = input("Enter your move: ")
+                        board.push_san(move)
+                        break
+                    except ValueError:
+                        print("Invalid move")
+            else:
+                moves = predictor(board)
+                move = max(moves, key=lambda x: moves[x])
+                print("AI move: ", move)
+                if stats_log:
+                    with open(stats_log, "a", encoding="utf-8") as log:
+                        write_json_line(
+                            log,
+                            {"ply": board.ply(), "fen": board.fen(), "move": move.uci()}
+                            | predictor.stats.to_dict(),
+                        )
+                board.push(move)
     print(board.result())
     print()
 
@@ -40,8 +58,22 @@ def play_against_ai(checkpoint: str):
 
 @click.command()
 @click.option("--checkpoint", default="network_9.pth")
-def main(checkpoint: str):
-    play_against_ai(checkpoint)
+@click.option(
+    "--workers", default=1, help="Search processes, they split the node budget"
+)
+@click.option("--stats-log", default=None, help="JSON lines file for search stats")
+@click.option("--cache", is_flag=True, help="Cache the evaluations of positions")
+@click.option(
+    "--cache-file", default=None, help="Load the cache from and save it to this file"
+)
+def main(
+    checkpoint: str,
+    workers: int,
+    stats_log: str | None,
+    cache: bool,
+    cache_file: str | None,
+):
+    play_against_ai(checkpoint, workers, stats_log, cache, cache_file)
 
 
 if __name__ == "__main__":
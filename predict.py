@@ -1,28 +1,167 @@
+import warnings
+
 import chess
 import click
+import numpy as np
 import torch
 
-from network import Network
+from network import Network, PolicyNetwork, is_policy_state_dict
+from search_stats import SearchStats
 import to_matrix
 
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
 
-class Predictor:
-    def __init__(self, checkpoint: str = "network_9.pt", *network_params):
-        self.network = Network(*network_params)  # 48, 3, 128, 2)
-        self.network.load_state_dict(
-            torch.load(checkpoint, map_location=torch.device("cpu"))
+# Exported by export.py, see load_artifact
+ARTIFACT_SUFFIXES = (".ts", ".onnx")
+
+
+class OnnxNetwork:
+    def __init__(self, path: str, threads: int | None = None):
+        if onnxruntime is None:
+            raise ImportError("Loading .onnx models needs the onnxruntime package")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or 0
+        # Fuses the conv/ReLU stacks among other graph rewrites
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
         )
+        self.family = self.session.get_modelmeta().custom_metadata_map.get("family")
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.from_numpy(self.session.run(None, {"planes": x.numpy()})[0])
+
+    def eval(self):
+        return self
+
+
+def load_artifact(path: str, threads: int | None = None):
+    # Returns the model and whether it is a PolicyNetwork
+    if path.endswith(".onnx"):
+        network = OnnxNetwork(path, threads)
+        return network, network.family == "policy"
+    extra_files = {"family": ""}
+    network = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    # The export is frozen, the fusions of optimize_for_inference can't be
+    # serialized and are done when loading. It is deprecated with the rest
+    # of TorchScript, where it is gone the frozen module runs as it is.
+    optimize = getattr(torch.jit, "optimize_for_inference", None)
+    if optimize is not None:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            network = optimize(network)
+    return network, extra_files["family"] == b"policy"
+
+
+class Predictor:
+    def __init__(
+        self,
+        checkpoint: str | None = "network_9.pt",
+        *network_params,
+        policy: bool | None = None,
+        threads: int | None = None,
+    ):
+        # The model family is read from the checkpoint unless policy is given.
+        # Without a checkpoint the network keeps its random initialization.
+        # Artifacts written by export.py are loaded as they are.
+        # Encoding and forward times go there when a search sets it
+        self.stats: SearchStats | None = None
+        self.threads = threads
+        # Loaded artifacts can't be pickled, the path is sent to worker
+        # processes instead and they load it again
+        self.artifact: str | None = None
+        if threads:
+            torch.set_num_threads(threads)
+        if checkpoint is not None and checkpoint.endswith(ARTIFACT_SUFFIXES):
+            self.artifact = checkpoint
+            self.network, self.policy = load_artifact(checkpoint, threads)
+            return
+        state_dict = None
+        if checkpoint is not None:
+            state_dict = torch.load(checkpoint, map_location=torch.device("cpu"))
+        if policy is None:
+            policy = state_dict is not None and is_policy_state_dict(state_dict)
+        self.policy = policy
+        if policy:
+            self.network = PolicyNetwork(*network_params)
+        else:
+            self.network = Network(*network_params)  # 48, 3, 128, 2)
+        if state_dict is not None:
+            self.network.load_state_dict(state_dict)
         self.network.eval()
 
-    def __call__(self, board) -> dict[chess.Move, float]:
-        moves = []
-        for move in board.legal_moves:
-            matrix = to_matrix.board_and_move_to_matrix(board, move)
-            moves.append(matrix)
-        moves = torch.Tensor(moves)
-        with torch.no_grad():
-            ratings = self.network(moves).numpy()
-        return {move: rating[0] for move, rating in zip(board.legal_moves, ratings)}
+    def __getstate__(self) -> dict:
+        state = dict(self.__dict__, stats=None)
+        if self.artifact is not None:
+            del state["network"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if self.artifact is not None:
+            self.network, self.policy = load_artifact(self.artifact, self.threads)
+
+    def __call__(self, board: chess.Board) -> dict[chess.Move, float]:
+        return self.predict_many([board])[0]
+
+    def predict_many(self, boards: list[chess.Board]) -> list[dict[chess.Move, float]]:
+        legal_moves = [list(board.legal_moves) for board in boards]
+        if not any(legal_moves):
+            return [{} for _ in boards]
+        if self.policy:
+            return self.predict_policy(boards, legal_moves)
+        moves = torch.from_numpy(
+            np.concatenate(
+                [
+                    to_matrix.board_and_moves_to_matrix(board, board_moves)
+                    for board, board_moves in zip(boards, legal_moves)
+                ]
+            )
+        )
+        stats = self.stats
+        if stats is not None:
+            stats.lap("encode")
+        with torch.inference_mode():
+            ratings = self.network(moves)[:, 0].numpy()
+        if stats is not None:
+            stats.lap("forward")
+        predictions = []
+        start = 0
+        for board_moves in legal_moves:
+            end = start + len(board_moves)
+            predictions.append(dict(zip(board_moves, ratings[start:end])))
+            start = end
+        return predictions
+
+    def predict_policy(
+        self, boards: list[chess.Board], legal_moves: list[list[chess.Move]]
+    ) -> list[dict[chess.Move, float]]:
+        # One forward pass per position, the scores are the softmax of the
+        # logits over the legal moves
+        planes = torch.from_numpy(to_matrix.boards_to_policy_planes(boards))
+        stats = self.stats
+        if stats is not None:
+            stats.lap("encode")
+        with torch.inference_mode():
+            logits = self.network(planes).numpy()
+        if stats is not None:
+            stats.lap("forward")
+        predictions = []
+        for board_logits, board_moves in zip(logits, legal_moves):
+            if not board_moves:
+                predictions.append({})
+                continue
+            indices = to_matrix.codes_to_policy_indices(
+                [to_matrix.move_to_code(move) for move in board_moves]
+            )
+            scores = np.exp(board_logits[indices] - board_logits[indices].max())
+            predictions.append(dict(zip(board_moves, scores / scores.sum())))
+        return predictions
 
 
 def Predictor_large(checkpoint):
@@ -31,8 +170,9 @@ def Predictor_large(checkpoint):
 
 @click.command()
 @click.option("--checkpoint", default="network_9.pt")
-def main(checkpoint: str):
-    predictor = Predictor(checkpoint)
+@click.option("--threads", default=None, type=int)
+def main(checkpoint: str, threads: int | None):
+    predictor = Predictor(checkpoint, threads=threads)
     while True:
         fen = input("Enter FEN: ")
         board = chess.Board(fen)
@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+from typing import Callable, Iterator
+
+import chess
+import chess.polyglot
+import numpy as np
+
+from search_tree import predict_batch
+from to_matrix import code_to_move, move_to_code
+
+# Rough per-entry cost of the dict slot, key tuple and array headers
+ENTRY_OVERHEAD = 320
+
+CacheKey = tuple[int, int, int]
+
+
+def cache_key(board: chess.Board) -> CacheKey:
+    return (
+        chess.polyglot.zobrist_hash(board),
+        board.castling_rights,
+        -1 if board.ep_square is None else board.ep_square,
+    )
+
+
+class CachedPredictor:
+    def __init__(
+        self,
+        predict: Callable[[chess.Board], dict[chess.Move, float]],
+        max_entries: int | None = 100000,
+        max_bytes: int | None = None,
+        path: str | None = None,
+    ):
+        self.predict = predict
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[CacheKey, tuple[np.ndarray, np.ndarray]] = (
+            OrderedDict()
+        )
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __call__(self, board: chess.Board) -> dict[chess.Move, float]:
+        return self.predict_many([board])[0]
+
+    def predict_many(self, boards: list[chess.Board]) -> list[dict[chess.Move, float]]:
+        keys = [cache_key(board) for board in boards]
+        # Hits are read before the misses are stored, storing can evict them
+        predictions: dict[CacheKey, dict[chess.Move, float]] = {}
+        missing: dict[CacheKey, chess.Board] = {}
+        for key, board in zip(keys, boards):
+            if key in predictions or key in missing:
+                self.hits += 1
+            elif key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                predictions[key] = self.lookup(key)
+            else:
+                self.misses += 1
+                missing[key] = board
+        for key, prediction in zip(
+            missing, predict_batch(self.predict, list(missing.values()))
+        ):
+            predictions[key] = prediction
+            self.store(
+                key,
+                np.fromiter(map(move_to_code, prediction), np.uint16, len(prediction)),
+                np.fromiter(prediction.values(), np.float32, len(prediction)),
+            )
+        return [predictions[key] for key in keys]
+
+    def lookup(self, key: CacheKey) -> dict[chess.Move, float]:
+        codes, scores = self.entries[key]
+        return {code_to_move(int(code)): score for code, score in zip(codes, scores)}
+
+    def store(self, key: CacheKey, codes: np.ndarray, scores: np.ndarray):
+        if key in self.entries:
+            return
+        self.entries[key] = (codes, scores)
+        self.nbytes += codes.nbytes + scores.nbytes + ENTRY_OVERHEAD
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            _key, (codes, scores) = self.entries.popitem(last=False)
+            self.nbytes -= codes.nbytes + scores.nbytes + ENTRY_OVERHEAD
+
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def save(self, path: str):
+        # Entries are written least recently used first, so loading them back
+        # restores the eviction order
+        keys = list(self.entries)
+        values = list(self.entries.values())
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                hashes=np.array([key[0] for key in keys], dtype=np.uint64),
+                castling_rights=np.array([key[1] for key in keys], dtype=np.uint64),
+                ep_squares=np.array([key[2] for key in keys], dtype=np.int8),
+                lengths=np.array([len(codes) for codes, _ in values], np.uint16),
+                codes=np.concatenate(
+                    [codes for codes, _ in values] or [np.empty(0, np.uint16)]
+                ),
+                scores=np.concatenate(
+                    [scores for _, scores in values] or [np.empty(0, np.float32)]
+                ),
+            )
+
+    def load(self, path: str):
+        with np.load(path) as data:
+            keys = zip(
+                data["hashes"].tolist(),
+                data["castling_rights"].tolist(),
+                data["ep_squares"].tolist(),
+            )
+            offsets = np.cumsum(data["lengths"], dtype=np.int64)
+            codes = np.split(data["codes"], offsets[:-1])
+            scores = np.split(data["scores"], offsets[:-1])
+        for key, key_codes, key_scores in zip(keys, codes, scores):
+            self.store(key, key_codes, key_scores)
+
+
+@contextmanager
+def cache_session(
+    predict: Callable[[chess.Board], dict[chess.Move, float]],
+    cache: bool = False,
+    path: str | None = None,
+) -> Iterator[Callable[[chess.Board], dict[chess.Move, float]]]:
+    # Wraps predict in a CachedPredictor when cache is set or a path is
+    # given. The cache is loaded from the path and saved back to it at the
+    # end, so a later session with the same checkpoint starts warm.
+    if not cache and path is None:
+        yield predict
+        return
+    cached = CachedPredictor(predict, path=path)
+    try:
+        yield cached
+    finally:
+        if path is not None:
+            cached.save(path)
@@ -1,80 +1,87 @@
 import chess
 import pygame
 
+FRAMES_PER_SECOND = 30
+LIGHT = (255, 255, 255)
+DARK = (31, 63, 127)
+HIGHLIGHT = (0, 255, 0)
+
 
 class ChessGame:
     def __init__(self, board: chess.Board, cell_size: int = 100):
         self.board = board
         self.cell_size = cell_size
         self.starting_position = None
+        # Piece images by symbol, loaded on first use
+        self.sprites: dict[str, pygame.Surface] = {}
+        # What each square showed when it was last drawn, only the squares
+        # that changed since are drawn again
+        self.drawn: dict[chess.Square, tuple[str | None, bool]] = {}
+        # Created after pygame.init()
+        self.clock = pygame.time.Clock()
 
-    def draw_board(self, screen):
-        # Draw the board
-        for row in range(8):
-            for column in range(8):
-                if (row + column) % 2 == 0:
-                    pygame.draw.rect(
-                        screen,
-                        (255, 255, 255),
-                        (
-                            row * self.cell_size,
-                            column * self.cell_size,
-                            self.cell_size,
-                            self.cell_size,
-                        ),
-                    )
-                else:
-                    pygame.draw.rect(
-                        screen,
-                        (31, 63, 127),
-                        (
-                            row * self.cell_size,
-                            column * self.cell_size,
-                            self.cell_size,
-                            self.cell_size,
-                        ),
-                    )
+    def sprite(self, symbol: str) -> pygame.Surface:
+        if symbol not in self.sprites:
+            self.sprites[symbol] = pygame.image.load(
+                f"assets/{symbol}.png"
+            ).convert_alpha()
+        return self.sprites[symbol]
 
-    def draw_pieces(self, screen):
-        # Draw the pieces
-        for row in range(8):
-            for column in range(8):
-                piece = self.board.piece_at(chess.square(row, column))
-                if piece is not None:
-                    screen.blit(
-                        pygame.image.load(
-                            f"assets/{piece.symbol()}.png"
-                        ).convert_alpha(),
-                        (row * self.cell_size, (7 - column) * self.cell_size),
-                    )
+    def square_rect(self, square: chess.Square) -> pygame.Rect:
+        return pygame.Rect(
+            chess.square_file(square) * self.cell_size,
+            (7 - chess.square_rank(square)) * self.cell_size,
+            self.cell_size,
+            self.cell_size,
+        )
 
-    def draw_legal_moves(self, screen, starting_position):
-        # Draw the legal moves
-        for move in self.board.legal_moves:
-            if move.from_square == starting_position:
-                pygame.draw.rect(
-                    screen,
-                    (0, 255, 0),
-                    (
-                        chess.square_file(move.to_square) * self.cell_size,
-                        (7 - chess.square_rank(move.to_square)) * self.cell_size,
-                        self.cell_size,
-                        self.cell_size,
-                    ),
-                )
+    def legal_targets(self, starting_position) -> set[chess.Square]:
+        if starting_position is None:
+            return set()
+        return {
+            move.to_square
+            for move in self.board.legal_moves
+            if move.from_square == starting_position
+        }
+
+    def draw_square(self, screen, square: chess.Square, highlighted: bool):
+        # Legal move targets are filled over their piece
+        rect = self.square_rect(square)
+        if highlighted:
+            color = HIGHLIGHT
+        elif (chess.square_file(square) + 7 - chess.square_rank(square)) % 2 == 0:
+            color = LIGHT
+        else:
+            color = DARK
+        pygame.draw.rect(screen, color, rect)
+        piece = self.board.piece_at(square)
+        if piece is not None and not highlighted:
+            screen.blit(self.sprite(piece.symbol()), rect.topleft)
 
     def draw(self, screen, starting_position=None):
-        self.draw_board(screen)
-        self.draw_pieces(screen)
-        if starting_position is not None:
-            self.draw_legal_moves(screen, starting_position)
-        pygame.display.update()
+        targets = self.legal_targets(starting_position)
+        changed = []
+        for square in chess.SQUARES:
+            piece = self.board.piece_at(square)
+            state = (piece and piece.symbol(), square in targets)
+            if self.drawn.get(square) == state:
+                continue
+            self.draw_square(screen, square, state[1])
+            self.drawn[square] = state
+            changed.append(self.square_rect(square))
+        if changed:
+            pygame.display.update(changed)
 
     def iteration(self, screen, allow_actions):
+        # One frame, at most FRAMES_PER_SECOND of them per second
         self.draw(screen, self.starting_position)
+        self.clock.tick(FRAMES_PER_SECOND)
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 return False
+            elif event.type == pygame.WINDOWEXPOSED:
+                # The window was covered, everything is drawn again
+                self.drawn.clear()
             elif (
                 allow_actions
                 and event.type == pygame.MOUSEBUTTONDOWN
@@ -112,10 +119,10 @@ class ChessGame:
 
 def main():
     cell_size = 64
-    game = ChessGame(chess.Board(), cell_size)
     pygame.init()
     screen = pygame.display.set_mode((8 * cell_size, 8 * cell_size))
     pygame.display.set_caption("Chess")
+    game = ChessGame(chess.Board(), cell_size)
     while game.iteration(screen, True):
         pass
 
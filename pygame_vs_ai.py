@@ -1,36 +1,90 @@
 import glob
+import threading
 
 import chess
 import chess.pgn
+import click
 import pygame
 
-from amplify import amplified_predictor
+from amplify import ParallelSearcher, Searcher, make_searcher
 from predict import Predictor
+from prediction_cache import cache_session
 from pygame_interface import ChessGame
 
 
-def main():
+class BackgroundSearch:
+    # Runs the searcher on a worker thread so the window keeps responding
+    def __init__(self, searcher: Searcher | ParallelSearcher, board: chess.Board):
+        self.searcher = searcher
+        self.values: dict[chess.Move, float] | None = None
+        # Raised again on the UI thread by result()
+        self.error: Exception | None = None
+        self.thread = threading.Thread(
+            target=self.run, args=(board.copy(),), daemon=True
+        )
+        self.thread.start()
+
+    def run(self, board: chess.Board):
+        try:
+            self.values = self.searcher(board)
+        except Exception as error:
+            self.error = error
+
+    def done(self) -> bool:
+        return not self.thread.is_alive()
+
+    def result(self) -> dict[chess.Move, float]:
+        if self.error is not None:
+            raise self.error
+        return self.values
+
+    def cancel(self):
+        # stop() does nothing until the search has started, so it is repeated
+        while self.thread.is_alive():
+            self.searcher.stop()
+            self.thread.join(0.05)
+
+
+@click.command()
+@click.option(
+    "--workers", default=1, help="Search processes, they split the node budget"
+)
+@click.option("--nodes", default=2, help="Explored leaves per move")
+@click.option("--cache", is_flag=True, help="Cache the evaluations of positions")
+@click.option(
+    "--cache-file", default=None, help="Load the cache from and save it to this file"
+)
+def main(workers: int, nodes: int, cache: bool, cache_file: str | None):
     cell_size = 64
-    predictor = amplified_predictor(Predictor("network_9.pth"), 2)
-    game = ChessGame(chess.Board(), cell_size)
-    pygame.init()
-    screen = pygame.display.set_mode((8 * cell_size, 8 * cell_size))
-    pygame.display.set_caption("Chess")
-    running = True
-    while running:
-        if game.board.is_game_over():
-            print("Game over")
-            break
-        ai_turn = game.board.turn == chess.BLACK
-        if ai_turn:
-            running = game.iteration(screen, False)
-            moves = predictor(game.board)
-            top_move = max(moves, key=lambda move: moves[move])
-            game.board.push(top_move)
-        else:
-            running = game.iteration(screen, True)
-
-    pygame.quit()
+    with cache_session(Predictor("network_9.pth"), cache, cache_file) as predict:
+        predictor = make_searcher(predict, nodes, workers=workers)
+        pygame.init()
+        screen = pygame.display.set_mode((8 * cell_size, 8 * cell_size))
+        pygame.display.set_caption("Chess")
+        game = ChessGame(chess.Board(), cell_size)
+        search: BackgroundSearch | None = None
+        running = True
+        try:
+            while running:
+                if game.board.is_game_over():
+                    print("Game over")
+                    break
+                ai_turn = game.board.turn == chess.BLACK
+                if ai_turn and search is None:
+                    search = BackgroundSearch(predictor, game.board)
+                    pygame.display.set_caption("Chess - thinking...")
+                elif ai_turn and search.done():
+                    moves = search.result()
+                    top_move = max(moves, key=lambda move: moves[move])
+                    game.board.push(top_move)
+                    search = None
+                    pygame.display.set_caption("Chess")
+                running = game.iteration(screen, not ai_turn)
+        finally:
+            if search is not None:
+                search.cancel()
+            predictor.close()
+            pygame.quit()
 
     pgn = chess.pgn.Game.from_board(game.board)
     pgn.headers["Event"] = "Chess AI vs Human"
@@ -0,0 +1,113 @@
+from dataclasses import asdict, dataclass, field
+import json
+import time
+from typing import IO, Iterator
+
+PHASES = [
+    "select",
+    "copy",
+    "encode",
+    "forward",
+    "predict",
+    "expand",
+    "game_over",
+    "backpropagate",
+]
+
+
+@dataclass
+class SearchStats:
+    # Filled in by SearchTree, Predictor and Searcher while a search runs when
+    # they are given one; they only check for None otherwise. Phase times use
+    # a single running clock, every lap() charges the time since the previous
+    # one to a phase.
+    nodes: int = 0
+    explored: int = 0
+    seconds: float = 0.0
+    max_depth: int = 0
+    mean_depth: float = 0.0
+    phases: dict[str, float] = field(default_factory=lambda: dict.fromkeys(PHASES, 0.0))
+    batch_sizes: dict[int, int] = field(default_factory=dict)
+    cache_hits: int | None = None
+    cache_misses: int | None = None
+    principal_variation: list[str] = field(default_factory=list)
+    clock: float = field(default_factory=time.perf_counter, repr=False)
+
+    def lap(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] += now - self.clock
+        self.clock = now
+
+    def restart_clock(self):
+        self.clock = time.perf_counter()
+
+    def add_batch(self, size: int):
+        self.nodes += size
+        self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+
+    @property
+    def nodes_per_second(self) -> float:
+        return self.nodes / self.seconds if self.seconds else 0.0
+
+    @property
+    def cache_hit_rate(self) -> float | None:
+        if self.cache_hits is None or not self.cache_hits + self.cache_misses:
+            return None
+        return self.cache_hits / (self.cache_hits + self.cache_misses)
+
+    def to_dict(self) -> dict:
+        record = asdict(self)
+        del record["clock"]
+        record["nodes_per_second"] = self.nodes_per_second
+        record["cache_hit_rate"] = self.cache_hit_rate
+        return record
+
+    @classmethod
+    def combine(cls, records: list["SearchStats"]) -> "SearchStats":
+        # Totals over searches that ran side by side, like the workers of a
+        # ParallelSearcher; the principal variation is the first record's
+        combined = cls(
+            principal_variation=records[0].principal_variation if records else []
+        )
+        for record in records:
+            combined.nodes += record.nodes
+            combined.explored += record.explored
+            combined.seconds = max(combined.seconds, record.seconds)
+            combined.max_depth = max(combined.max_depth, record.max_depth)
+            combined.mean_depth += record.mean_depth / len(records)
+            for phase, seconds in record.phases.items():
+                combined.phases[phase] += seconds
+            for size, count in record.batch_sizes.items():
+                combined.batch_sizes[size] = combined.batch_sizes.get(size, 0) + count
+            if record.cache_hits is not None:
+                combined.cache_hits = (combined.cache_hits or 0) + record.cache_hits
+                combined.cache_misses = (
+                    combined.cache_misses or 0
+                ) + record.cache_misses
+        return combined
+
+
+def predictor_chain(predict) -> Iterator:
+    # The predictor and the ones it wraps, like CachedPredictor.predict
+    while predict is not None:
+        yield predict
+        predict = getattr(predict, "predict", None)
+
+
+def attach(predict, stats: SearchStats | None):
+    # Hands the record to every predictor in the chain that can fill it in
+    for predictor in predictor_chain(predict):
+        if hasattr(predictor, "stats"):
+            predictor.stats = stats
+
+
+def cache_counters(predict) -> tuple[int, int] | None:
+    for predictor in predictor_chain(predict):
+        if hasattr(predictor, "hits") and hasattr(predictor, "misses"):
+            return predictor.hits, predictor.misses
+    return None
+
+
+def write_json_line(file: IO, record: dict):
+    file.write(json.dumps(record) + "\n")
+    file.flush()
@@ -0,0 +1,352 @@
+from __future__ import annotations
+import math
+from typing import Callable
+
+import chess
+import numpy as np
+
+from search_stats import SearchStats
+from to_matrix import code_to_move, move_to_code
+
+NODE_FIELDS = {
+    "parent": np.int32,
+    "first_child": np.int32,
+    "n_children": np.uint16,
+    "move": np.uint16,
+    "prior": np.float32,
+    "fullmove_number": np.uint16,
+    "game_over": np.bool_,
+    "n_leaves": np.int32,
+    "expansion": np.float64,
+    "value": np.float64,
+}
+
+
+def predict_batch(
+    predict: Callable[[chess.Board], dict[chess.Move, float]],
+    boards: list[chess.Board],
+) -> list[dict[chess.Move, float]]:
+    if hasattr(predict, "predict_many"):
+        return predict.predict_many(boards)
+    return [predict(board) for board in boards]
+
+
+# Array-backed equivalent of a tree of `benchmark_tree.Scenario` nodes: nodes live in
+# preallocated arrays that grow in chunks, the children of a node are stored
+# contiguously, and boards are rebuilt by pushing the moves along the selected
+# path onto a single root board.
+class SearchTree:
+    def __init__(
+        self,
+        board: chess.Board,
+        predict: Callable[[chess.Board], dict[chess.Move, float]],
+        chunk_size: int = 4096,
+        depth_coef: float = 1.25,
+        rewarded_move_number: float = 24,
+        score_override_coef: float = 0.1,
+    ):
+        self.board = board.copy()
+        self.predict = predict
+        self.chunk_size = chunk_size
+        self.depth_coef = depth_coef
+        self.rewarded_move_number = rewarded_move_number
+        self.score_override_coef = score_override_coef
+        # Filled in during expansions when set, see search_stats
+        self.stats: SearchStats | None = None
+        self.size = 0
+        self.capacity = 0
+        for name, dtype in NODE_FIELDS.items():
+            setattr(self, name, np.empty(0, dtype=dtype))
+        root = self.allocate(1)
+        self.init_node(root, -1, None, 0, self.board)
+
+    def allocate(self, n: int) -> int:
+        if self.size + n > self.capacity:
+            n_chunks = -(-(self.size + n - self.capacity) // self.chunk_size)
+            self.capacity += n_chunks * self.chunk_size
+            for name in NODE_FIELDS:
+                array = getattr(self, name)
+                grown = np.empty(self.capacity, dtype=array.dtype)
+                grown[: self.size] = array[: self.size]
+                setattr(self, name, grown)
+        start = self.size
+        self.size += n
+        return start
+
+    def init_node(
+        self,
+        node: int,
+        parent: int,
+        move: chess.Move | None,
+        score: float,
+        board: chess.Board,
+    ):
+        self.parent[node] = parent
+        self.first_child[node] = -1
+        self.n_children[node] = 0
+        self.move[node] = 0 if move is None else move_to_code(move)
+        self.prior[node] = score
+        self.fullmove_number[node] = board.fullmove_number
+        self.n_leaves[node] = 1
+        stats = self.stats
+        if stats is not None:
+            stats.lap("expand")
+        self.game_over[node] = board.is_game_over()
+        if stats is not None:
+            stats.lap("game_over")
+        # Special treatment for game over scenarios
+        if self.game_over[node]:
+            result = board.result()
+            self.expansion[node] = 0
+            # We return 1 for a win, 0 for a loss, and 0.5 for a draw
+            self.value[node] = 1 if result == "1-0" else (0 if result == "0-1" else 0.5)
+        else:
+            self.expansion[node] = self.prior[node]
+            self.value[node] = self.prior[node]
+
+    def children(self, node: int) -> range:
+        first = int(self.first_child[node])
+        return range(first, first + int(self.n_children[node]))
+
+    def select_leaf(self) -> int:
+        # Pushes the moves leading to the leaf onto self.board, see unwind
+        node = 0
+        while self.n_children[node]:
+            first = int(self.first_child[node])
+            node = first + int(
+                np.argmax(self.expansion[first : first + self.n_children[node]])
+            )
+            self.board.push(code_to_move(int(self.move[node])))
+        return node
+
+    def unwind(self, node: int):
+        while node:
+            self.board.pop()
+            node = int(self.parent[node])
+
+    def add_children(
+        self, node: int, board: chess.Board, scores: dict[chess.Move, float]
+    ):
+        first = self.allocate(len(scores))
+        self.first_child[node] = first
+        self.n_children[node] = len(scores)
+        for child, (move, score) in enumerate(scores.items(), first):
+            board.push(move)
+            self.init_node(child, node, move, score, board)
+            board.pop()
+
+    def move_numbers_price(self, moves: int):
+        sigmoid_value = math.exp(moves / self.rewarded_move_number) / (
+            1 + math.exp(moves / self.rewarded_move_number)
+        )
+        return sigmoid_value * 2 - 1
+
+    def children_expansion(self, node: int) -> float:
+        children = slice(
+            self.first_child[node], self.first_child[node] + self.n_children[node]
+        )
+        return (
+            np.sum(self.expansion[children] ** 2 / self.depth_coef)
+            / self.n_children[node]
+        ) ** 0.5
+
+    def children_value(self, node: int) -> float:
+        children = slice(
+            self.first_child[node], self.first_child[node] + self.n_children[node]
+        )
+        return (
+            (1 - self.value[children].max()) ** (1 - self.score_override_coef)
+            * (float(self.prior[node]) ** self.score_override_coef)
+            * self.move_numbers_price(int(self.fullmove_number[node]))
+        )
+
+    def backpropagate(self, node: int, new_leaves: int):
+        while node >= 0:
+            self.n_leaves[node] += new_leaves
+            self.expansion[node] = self.children_expansion(node)
+            self.value[node] = self.children_value(node)
+            node = int(self.parent[node])
+
+    def add_virtual_loss(self, node: int):
+        # A leaf waiting for its prediction is never worth selecting again;
+        # backpropagate replaces this once its children are added
+        self.expansion[node] = 0
+        node = int(self.parent[node])
+        while node >= 0:
+            self.expansion[node] = self.children_expansion(node)
+            node = int(self.parent[node])
+
+    def expand(self) -> bool:
+        stats = self.stats
+        if stats is not None:
+            stats.restart_clock()
+        node = self.select_leaf()
+        try:
+            # if trying to expand a game over scenario, return False
+            if self.game_over[node]:
+                return False
+            if stats is not None:
+                stats.lap("select")
+                stats.add_batch(1)
+            scores = self.predict(self.board)
+            if stats is not None:
+                stats.lap("predict")
+            self.add_children(node, self.board, scores)
+        finally:
+            self.unwind(node)
+        if stats is not None:
+            stats.lap("expand")
+        self.backpropagate(node, len(scores) - 1)
+        if stats is not None:
+            stats.lap("backpropagate")
+        return True
+
+    def expand_batch(self, batch_size: int) -> bool:
+        if batch_size == 1:
+            return self.expand()
+        stats = self.stats
+        if stats is not None:
+            stats.restart_clock()
+        leaves, boards = self.select_batch(batch_size)
+        # if trying to expand a game over scenario, return False
+        if not leaves:
+            return False
+        if stats is not None:
+            stats.lap("select")
+            stats.add_batch(len(leaves))
+        predictions = predict_batch(self.predict, boards)
+        if stats is not None:
+            stats.lap("predict")
+        self.expand_leaves(leaves, boards, predictions)
+        return True
+
+    def select_batch(self, batch_size: int) -> tuple[list[int], list[chess.Board]]:
+        # Up to batch_size distinct leaves under virtual loss and their boards,
+        # to be predicted by the caller and passed on to expand_leaves
+        stats = self.stats
+        leaves: list[int] = []
+        boards: list[chess.Board] = []
+        while len(leaves) < batch_size:
+            node = self.select_leaf()
+            # Stop at a game over scenario or once only pending leaves are left
+            if self.game_over[node] or node in leaves:
+                self.unwind(node)
+                break
+            if stats is not None:
+                stats.lap("select")
+            boards.append(self.board.copy())
+            if stats is not None:
+                stats.lap("copy")
+            self.unwind(node)
+            leaves.append(node)
+            self.add_virtual_loss(node)
+        return leaves, boards
+
+    def expand_leaves(
+        self,
+        leaves: list[int],
+        boards: list[chess.Board],
+        predictions: list[dict[chess.Move, float]],
+    ):
+        stats = self.stats
+        for node, board, scores in zip(leaves, boards, predictions):
+            self.add_children(node, board, scores)
+            if stats is not None:
+                stats.lap("expand")
+            self.backpropagate(node, len(scores) - 1)
+            if stats is not None:
+                stats.lap("backpropagate")
+
+    def levels(self, node: int) -> list[np.ndarray]:
+        # The nodes of the subtree depth by depth
+        levels = [np.array([node], dtype=np.int64)]
+        while levels[-1].size:
+            frontier = levels[-1]
+            counts = self.n_children[frontier].astype(np.int64)
+            starts = self.first_child[frontier].astype(np.int64)[counts > 0]
+            counts = counts[counts > 0]
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            levels.append(np.repeat(starts, counts) + offsets)
+        return levels[:-1]
+
+    def subtree(self, node: int) -> np.ndarray:
+        # Breadth first, so the children of every node stay contiguous
+        return np.concatenate(self.levels(node))
+
+    def leaf_depths(self) -> np.ndarray:
+        return np.concatenate(
+            [
+                np.full(np.count_nonzero(self.n_children[level] == 0), depth)
+                for depth, level in enumerate(self.levels(0))
+            ]
+        )
+
+    def principal_variation(self) -> list[chess.Move]:
+        # The best move for the side to play at every node, values being
+        # from the point of view of the player who made the move
+        moves = []
+        node = 0
+        while self.n_children[node]:
+            children = self.children(node)
+            node = children[int(np.argmax(self.value[children.start : children.stop]))]
+            moves.append(code_to_move(int(self.move[node])))
+        return moves
+
+    def reroot(self, node: int):
+        # `node` can be any descendant of the root, the moves leading to it
+        # are played on the board and its subtree is copied once
+        path = []
+        while node > 0:
+            path.append(node)
+            node = int(self.parent[node])
+        for step in reversed(path):
+            self.board.push(code_to_move(int(self.move[step])))
+        node = path[0]
+        nodes = self.subtree(node)
+        new_index = np.full(self.size, -1, dtype=np.int64)
+        new_index[nodes] = np.arange(nodes.size)
+        self.size = nodes.size
+        self.capacity = -(-self.size // self.chunk_size) * self.chunk_size
+        for name in NODE_FIELDS:
+            array = getattr(self, name)
+            kept = np.empty(self.capacity, dtype=array.dtype)
+            kept[: self.size] = array[nodes]
+            setattr(self, name, kept)
+        self.parent[0] = -1
+        self.parent[1 : self.size] = new_index[self.parent[1 : self.size]]
+        expanded = np.flatnonzero(self.n_children[: self.size])
+        self.first_child[expanded] = new_index[self.first_child[expanded]]
+
+    def advance(self, board: chess.Board) -> bool:
+        # Re-roots the tree on `board` if it follows from the current root
+        # by already explored moves, the tree is left as it is otherwise
+        played = len(self.board.move_stack)
+        if (
+            len(board.move_stack) < played
+            or board.move_stack[:played] != self.board.move_stack
+            or board.root() != self.board.root()
+        ):
+            return False
+        node = 0
+        for move in board.move_stack[played:]:
+            code = move_to_code(move)
+            node = next(
+                (child for child in self.children(node) if self.move[child] == code),
+                None,
+            )
+            if node is None:
+                return False
+        if node:
+            self.reroot(node)
+        return True
+
+    def n_explored(self) -> int:
+        return int(self.n_leaves[0])
+
+    def root_values(self) -> dict[chess.Move, float]:
+        return {
+            code_to_move(int(self.move[child])): float(self.value[child])
+            for child in self.children(0)
+        }
@@ -1,46 +1,21 @@
-import chess
-import chess.pgn
 import yaml
 
+from generate_dataset import PositionMoves, load_offset
+from pgn_index import GameIndex
+from pgn_io import open_pgn
+
 path = "./tactics.pgn"
 
 NUM_MOVES = 100000
 
-pgn = open(path)
-higher_rated_offsets = []
-
-count = 0
-while True:
-    offset = pgn.tell()
-    headers = chess.pgn.read_headers(pgn)
-    if headers is None or count > NUM_MOVES:
-        break
-    higher_rated_offsets.append(offset)
-    count += 1
+pgn = open_pgn(path)
+higher_rated_offsets = GameIndex.open(path).select()[: NUM_MOVES + 1].tolist()
 
-moves = {}
+moves = PositionMoves()
 
-count = 0
 for offset in higher_rated_offsets:
-    pgn.seek(offset)
-    game = chess.pgn.read_game(pgn)
-    if game.errors:
-        continue
-    board = game.board()
-    prev_fen = board.fen(en_passant="fen")
-    game = game.next()
-    while game:
-        board = game.board()
-        fen = board.fen(en_passant="fen")
-        move = str(game.san())
-        if prev_fen in moves:
-            moves[prev_fen].append(move)
-        else:
-            moves[prev_fen] = [move]
-        prev_fen = fen
-        game = game.next()
-        count += 1
+    load_offset(pgn, offset, moves)
 
 
 with open(f"tactics_{len(moves)}.yaml", "w") as f:
-    yaml.dump(moves, f)
+    yaml.dump(moves.to_dict(), f)
@@ -0,0 +1,80 @@
+from collections import Counter
+import shutil
+
+import chess.pgn
+import chess.polyglot
+import pytest
+
+from aggregate import PositionAggregator, load_offset_packed, write_dataset
+from benchmark import GAMES_PATH
+from binary_dataset import BinaryDataset, unpack_board
+from pgn_index import GameIndex
+from to_matrix import move_to_code
+
+N_GAMES = 40
+
+
+@pytest.fixture
+def games(tmp_path) -> list[list]:
+    path = str(tmp_path / "games.pgn")
+    shutil.copy(GAMES_PATH, path)
+    offsets = GameIndex.open(path).games["offset"][:N_GAMES].tolist()
+    with open(path, encoding="utf-8") as pgn:
+        return [load_offset_packed(pgn, offset) for offset in offsets]
+
+
+def mainline_counts() -> tuple[Counter, dict[int, str]]:
+    counts: Counter = Counter()
+    epds = {}
+    with open(GAMES_PATH, encoding="utf-8") as pgn:
+        for _ in range(N_GAMES):
+            game = chess.pgn.read_game(pgn)
+            board = game.board()
+            for move in game.mainline_moves():
+                key = chess.polyglot.zobrist_hash(board)
+                counts[key, move_to_code(move)] += 1
+                # Like the key, the legal en passant square only
+                epds[key] = board.epd()
+                board.push(move)
+    return counts, epds
+
+
+def merged_counts(aggregator: PositionAggregator) -> Counter:
+    counts: Counter = Counter()
+    for position, move_counts in aggregator.merged():
+        for move, count in move_counts.items():
+            counts[int(position["key"]), move] += count
+    return counts
+
+
+@pytest.mark.parametrize("memory_budget", [1 << 30, 20000])
+def test_counts_match_the_games(tmp_path, games, memory_budget):
+    aggregator = PositionAggregator(str(tmp_path), memory_budget)
+    for moves in games:
+        aggregator.add_game(moves)
+    if memory_budget < 1 << 30:
+        assert len(aggregator.runs) > 1
+    counts, epds = mainline_counts()
+    assert merged_counts(aggregator) == counts
+    keys = [int(position["key"]) for position, _ in aggregator.merged()]
+    assert keys == sorted(set(keys))
+    for position, _move_counts in aggregator.merged():
+        board = unpack_board(position)
+        assert board.epd() == epds[int(position["key"])]
+
+
+def test_write_dataset(tmp_path, games):
+    aggregator = PositionAggregator(str(tmp_path), 20000)
+    for moves in games:
+        aggregator.add_game(moves)
+    prefix = str(tmp_path / "positions")
+    write_dataset(aggregator, prefix, shard_size=500)
+    dataset = BinaryDataset(prefix)
+    counts, epds = mainline_counts()
+    assert len(dataset) == len(epds)
+    played = sum(
+        int(position["n_played"])
+        for shard in dataset.shards
+        for position in shard.positions
+    )
+    assert played == sum(counts.values())
@@ -0,0 +1,35 @@
+import chess
+
+from amplify import Searcher
+
+
+def uniform_predictor(board: chess.Board) -> dict[chess.Move, float]:
+    return {move: 0.5 for move in board.legal_moves}
+
+
+def test_stop_between_searches_is_ignored():
+    searcher = Searcher(uniform_predictor, 10)
+    searcher.search(chess.Board(), nodes=1)
+    searcher.stop()
+    searcher.search(chess.Board(), nodes=30)
+    assert searcher.explored >= 30
+
+
+def test_stop_during_search():
+    searcher = Searcher(None, 0)
+    calls = 0
+
+    def stopping_predictor(board: chess.Board) -> dict[chess.Move, float]:
+        nonlocal calls
+        calls += 1
+        if calls == 5:
+            searcher.stop()
+        return uniform_predictor(board)
+
+    searcher.predict = stopping_predictor
+    values = searcher.search(chess.Board())
+    assert len(values) == 20
+    assert calls == 5
+    # The next search is not stopped by the previous stop()
+    searcher.search(chess.Board(), nodes=30)
+    assert searcher.explored >= 30
@@ -0,0 +1,98 @@
+import chess
+import numpy as np
+import pytest
+import yaml
+
+from binary_dataset import BinaryDataset, convert, unpack_board
+from to_matrix import (
+    board_and_moves_to_matrix,
+    boards_to_policy_planes,
+    codes_to_policy_indices,
+    move_to_code,
+)
+
+# Castling rights, an en passant square, black to move and a promotion
+POSITIONS = {
+    chess.STARTING_FEN: ["e4", "e4", "d4", "Nf3"],
+    "rnbqkbnr/ppp1pppp/8/8/3pP3/5N2/PPPP1PPP/RNBQKB1R b KQkq e3 0 3": ["dxe3"],
+    "r3k2r/8/8/8/8/8/8/R3K2R w Kq - 0 1": ["O-O", "Ra8+"],
+    "8/1P6/8/8/8/2k5/8/4K3 w - - 0 1": ["b8=N", "b8=Q", "b8=Q"],
+}
+
+
+@pytest.fixture
+def dataset(tmp_path) -> BinaryDataset:
+    yaml_path = tmp_path / "positions.yaml"
+    yaml_path.write_text(yaml.dump(POSITIONS, sort_keys=False), encoding="utf-8")
+    prefix = str(tmp_path / "positions")
+    assert convert(str(yaml_path), prefix, shard_size=3) == 2
+    return BinaryDataset(prefix)
+
+
+def test_positions_round_trip(dataset):
+    boards = [
+        unpack_board(position)
+        for shard in dataset.shards
+        for position in shard.positions
+    ]
+    # The move counters are not stored
+    assert [board.epd(en_passant="fen") for board in boards] == [
+        chess.Board(fen).epd(en_passant="fen") for fen in POSITIONS
+    ]
+    shard = dataset.shards[0]
+    start = shard.positions[0]
+    codes = shard.moves[start["move_start"] : start["move_start"] + 20]
+    ratings = dict(zip(codes.tolist(), shard.ratings[start["move_start"] :].tolist()))
+    assert ratings[move_to_code(chess.Move.from_uci("e2e4"))] == 0.5
+    assert ratings[move_to_code(chess.Move.from_uci("g1f3"))] == 0.25
+    assert sum(ratings.values()) == pytest.approx(1)
+
+
+def test_policy_batches(dataset):
+    boards = [chess.Board(fen) for fen in POSITIONS]
+    batches = list(dataset.policy_batches(2, shuffle=False))
+    planes = np.concatenate([batch[0] for batch in batches])
+    targets = np.concatenate([batch[1] for batch in batches])
+    legal = np.concatenate([batch[2] for batch in batches])
+    assert np.array_equal(planes, boards_to_policy_planes(boards))
+    assert targets.sum(axis=1) == pytest.approx(np.ones(len(boards)))
+    for board, board_legal, board_targets in zip(boards, legal, targets):
+        codes = np.array([move_to_code(move) for move in board.legal_moves])
+        assert np.flatnonzero(board_legal).tolist() == sorted(
+            codes_to_policy_indices(codes).tolist()
+        )
+    promotions = boards[-1]
+    queen, knight = (
+        codes_to_policy_indices(np.array([move_to_code(promotions.parse_san(san))]))[0]
+        for san in ("b8=Q", "b8=N")
+    )
+    assert targets[-1, queen] == pytest.approx(2 / 3)
+    assert targets[-1, knight] == pytest.approx(1 / 3)
+
+
+def test_batches_match_the_matrix_encoding(dataset):
+    board = chess.Board(chess.STARTING_FEN)
+    (matrix, ratings), *_rest = dataset.batches(1, shuffle=False, seed=0)
+    # The 3 human moves and as many others as the 4 times one was played
+    assert len(matrix) == len(ratings) == 7
+    moves = [
+        chess.Move(int(np.argmax(row[-1])), int(np.argmax(row[-2]))) for row in matrix
+    ]
+    assert np.array_equal(matrix, board_and_moves_to_matrix(board, moves))
+    assert sorted(ratings[ratings > 0].tolist()) == [0.25, 0.25, 0.5]
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_parts_are_disjoint(dataset, shuffle):
+    parts = [
+        [
+            planes
+            for planes, _targets, _legal in dataset.policy_batches(
+                1, shuffle, seed=0, part=part, n_parts=3
+            )
+        ]
+        for part in range(3)
+    ]
+    rows = np.concatenate([planes for part in parts for planes in part])
+    assert len(rows) == len(dataset) == len(POSITIONS)
+    assert len(np.unique(rows.reshape(len(rows), -1), axis=0)) == len(POSITIONS)
@@ -0,0 +1,36 @@
+import chess
+
+from export import ranking_agreement
+
+
+def scores(board: chess.Board, values: list[float]) -> dict[chess.Move, float]:
+    return dict(zip(board.legal_moves, values))
+
+
+def test_unrankable_positions_are_skipped():
+    start = chess.Board()
+    # Black only has Kh8-g8
+    single = chess.Board("7k/R7/6K1/8/8/8/8/8 b - - 0 1")
+    assert single.legal_moves.count() == 1
+    n_moves = start.legal_moves.count()
+    increasing = scores(start, [float(i) for i in range(n_moves)])
+    constant = scores(start, [0.5] * n_moves)
+    only_move = scores(single, [1.0])
+    top_moves, correlation, n_ranked = ranking_agreement(
+        [increasing, increasing, only_move], [increasing, constant, only_move]
+    )
+    assert (top_moves, correlation, n_ranked) == (1.0, 1.0, 1)
+    assert ranking_agreement([only_move], [only_move]) == (0.0, 0.0, 0)
+
+
+def test_ties_share_their_rank():
+    # The order of the two tied moves can't change the correlation
+    board = chess.Board()
+    rest = [float(i) for i in range(2, board.legal_moves.count())]
+    tied = scores(board, [0.0, 0.0, *rest])
+    first = scores(board, [0.0, 1.0, *rest])
+    second = scores(board, [1.0, 0.0, *rest])
+    assert (
+        ranking_agreement([tied], [first])[1:]
+        == ranking_agreement([tied], [second])[1:]
+    )
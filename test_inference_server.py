@@ -0,0 +1,58 @@
+import os
+import tempfile
+import threading
+import time
+
+import chess
+import pytest
+import torch
+
+from inference_server import InferenceServer, RemotePredictor, server_running
+from network import PolicyNetwork
+from predict import Predictor
+
+AUTHKEY = b"test-key"
+
+
+@pytest.fixture(scope="module")
+def server():
+    # Unix socket paths are short, so not under pytest's tmp_path
+    directory = tempfile.mkdtemp(prefix="inference")
+    checkpoint = os.path.join(directory, "policy.pt")
+    torch.manual_seed(0)
+    torch.save(PolicyNetwork().state_dict(), checkpoint)
+    address = os.path.join(directory, "server.sock")
+    server = InferenceServer(address, max_latency=0.001, authkey=AUTHKEY)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    while not server_running(address):
+        time.sleep(0.01)
+    return address, checkpoint
+
+
+def test_remote_matches_local_on_en_passant_position(server):
+    address, checkpoint = server
+    board = chess.Board()
+    board.push_uci("e2e4")
+    # No black pawn can take on e3, the default FEN drops the square
+    assert board.ep_square == chess.E3 and "e3" not in board.fen()
+    local = Predictor(checkpoint)
+    remote = RemotePredictor(checkpoint, address, AUTHKEY)
+    try:
+        # The same batch on both sides, so the scores are the same bits
+        boards = [board, chess.Board()]
+        assert remote.predict_many(boards) == local.predict_many(boards)
+    finally:
+        remote.close()
+
+
+def test_wrong_key_is_refused(server):
+    address, checkpoint = server
+    remote = RemotePredictor(checkpoint, address, b"wrong")
+    with pytest.raises(Exception):
+        remote(chess.Board())
+
+
+def test_second_server_refuses_to_start(server):
+    address, _checkpoint = server
+    with pytest.raises(RuntimeError):
+        InferenceServer(address, authkey=AUTHKEY).serve_forever()
@@ -0,0 +1,41 @@
+import random
+
+import chess
+import numpy as np
+import pytest
+import torch
+
+from binary_dataset import BinaryDataset, ShardWriter
+from network import PolicyBatches, strategy_loader
+
+
+@pytest.fixture
+def prefix(tmp_path):
+    # 50 distinct positions of one random game, in shards of 8
+    prefix = str(tmp_path / "positions")
+    writer = ShardWriter(prefix, shard_size=8)
+    rng = random.Random(0)
+    board = chess.Board()
+    for _ in range(50):
+        moves = list(board.legal_moves)
+        writer.add(board, {rng.choice(moves): 1})
+        board.push(rng.choice(moves))
+    writer.close()
+    return prefix
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_loader_workers_read_every_position_once(prefix, workers):
+    planes = torch.cat(
+        [
+            batch
+            for batch, _targets in strategy_loader(PolicyBatches(prefix, 4), workers)
+        ]
+    )
+    assert len(planes) == 50
+    assert len(np.unique(planes.flatten(1).numpy(), axis=0)) == 50
+
+
+def test_unseeded_parts_are_refused(prefix):
+    with pytest.raises(ValueError):
+        next(BinaryDataset(prefix).batches(seed=None, part=0, n_parts=2))
@@ -0,0 +1,85 @@
+import os
+
+import chess.pgn
+import numpy as np
+
+from pgn_index import GameIndex, build_index, index_path
+
+PGN = """[Event "First"]
+[WhiteElo "1500"]
+[BlackElo "?"]
+[Result "1-0"]
+[TimeControl "180+2"]
+
+1. e4 { a comment with 2. d4 } e5 2. Nf3 (2. f4 exf4 3. Nf3) 2... Nc6 3. Bb5 1-0
+
+[Event "Second"]
+[WhiteElo "2100"]
+[BlackElo "2050"]
+[Result "1/2-1/2"]
+[TimeControl "-"]
+
+1. d4 d5 2. c4 dxc4 3. e3 b5 4. a4 c6 5. axb5 cxb5 6. Qf3 1/2-1/2
+
+[Event "Third"]
+[WhiteElo "2400"]
+[BlackElo "900"]
+[Result "*"]
+[TimeControl "600"]
+
+1. e4 c5 *
+"""
+
+
+def write_pgn(tmp_path) -> str:
+    path = str(tmp_path / "games.pgn")
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(PGN)
+    return path
+
+
+def test_build_index(tmp_path):
+    path = write_pgn(tmp_path)
+    index = build_index(path)
+    assert os.path.exists(index_path(path))
+    assert index["white_elo"].tolist() == [1500, 2100, 2400]
+    assert index["black_elo"].tolist() == [-1, 2050, 900]
+    assert index["result"].tolist() == [1, 0, -2]
+    # Moves in comments and variations are not counted
+    assert index["plies"].tolist() == [5, 11, 2]
+    assert index["base_time"].tolist() == [180, -1, 600]
+    assert index["increment"].tolist() == [2, -1, 0]
+    with open(path, encoding="utf-8") as file:
+        for offset, event in zip(
+            index["offset"].tolist(), ["First", "Second", "Third"]
+        ):
+            file.seek(offset)
+            assert chess.pgn.read_game(file).headers["Event"] == event
+    assert (
+        index["offset"][1:].tolist()
+        == (index["offset"][:-1] + index["length"][:-1]).tolist()
+    )
+    assert int(index["offset"][-1] + index["length"][-1]) == len(PGN.encode())
+
+
+def test_filters(tmp_path):
+    games = GameIndex.open(write_pgn(tmp_path))
+    assert len(games) == 3
+    assert games.mask(min_elo=2000).tolist() == [False, True, False]
+    assert games.mask(min_elo=2000, both=False).tolist() == [False, True, True]
+    assert games.mask(max_elo=1600, both=False).tolist() == [True, False, True]
+    assert games.mask(min_plies=5, results=[0, 1]).tolist() == [True, True, False]
+    assert games.mask(base_time=180, increment=2).tolist() == [True, False, False]
+    assert np.array_equal(games.select(min_elo=2000), games.games["offset"][1:2])
+
+
+def test_stale_index_is_rebuilt(tmp_path):
+    path = write_pgn(tmp_path)
+    assert len(GameIndex.open(path)) == 3
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('\n[Event "Fourth"]\n[Result "0-1"]\n\n1. f3 e5 2. g4 Qh4# 0-1\n')
+    mtime = os.path.getmtime(index_path(path))
+    os.utime(path, (mtime + 10, mtime + 10))
+    games = GameIndex.open(path)
+    assert len(games) == 4
+    assert games.games["result"][-1] == -1 and games.games["plies"][-1] == 4
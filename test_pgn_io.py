@@ -0,0 +1,60 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from benchmark import GAMES_PATH
+from pgn_index import build_index
+from pgn_io import DecompressedPGN, frames_path, open_pgn, reframe
+
+
+@pytest.fixture
+def games(tmp_path) -> str:
+    path = str(tmp_path / "games.pgn")
+    shutil.copy(GAMES_PATH, path)
+    return path
+
+
+@pytest.mark.parametrize("suffix", ["bz2", "xz", "zst"])
+def test_reframed_file_reads_and_seeks_like_the_original(games, suffix):
+    if suffix == "zst":
+        pytest.importorskip("zstandard")
+    compressed = f"{games}.{suffix}"
+    n_frames = reframe(games, compressed, frame_size=16 << 10)
+    assert n_frames > 1
+    assert len(np.load(frames_path(compressed))) == n_frames
+    with open(games, "rb") as file:
+        data = file.read()
+    with open_pgn(compressed, binary=True) as pgn:
+        assert b"".join(pgn) == data
+    index = build_index(games)
+    assert np.array_equal(build_index(compressed), index)
+    # Backwards and forwards, across frames
+    offsets = index["offset"].tolist()
+    with open_pgn(compressed) as pgn:
+        for offset in offsets[::-7] + offsets[::5]:
+            pgn.seek(offset)
+            assert pgn.tell() == offset
+            line = pgn.readline()
+            assert line.startswith("[Event ")
+            assert line.encode() == data[offset : offset + len(line)]
+
+
+def test_single_frame_file_saves_no_frames(games):
+    compressed = f"{games}.bz2"
+    reframe(games, compressed)
+    os.remove(frames_path(compressed))
+    with DecompressedPGN(compressed, chunk_size=4096) as pgn:
+        pgn.seek(1000)
+        assert pgn.tell() == 1000
+        while pgn.readline():
+            pass
+    assert not os.path.exists(frames_path(compressed))
+
+
+def test_uncompressed_files_open_directly(games):
+    with open_pgn(games) as pgn:
+        assert pgn.readline().startswith("[Event ")
+    with pytest.raises(ValueError):
+        reframe(games, f"{games}.gz")
@@ -0,0 +1,22 @@
+import pickle
+
+import chess
+import pytest
+
+from export import export
+from predict import Predictor
+
+
+@pytest.mark.parametrize("suffix", [".ts", ".onnx"])
+def test_artifact_predictor_pickles(tmp_path, suffix):
+    if suffix == ".onnx":
+        pytest.importorskip("onnxruntime")
+    path = str(tmp_path / f"network{suffix}")
+    export(None, path)
+    predictor = Predictor(path, threads=1)
+    copy = pickle.loads(pickle.dumps(predictor))
+    assert copy.artifact == path and copy.policy == predictor.policy
+    board = chess.Board()
+    expected = predictor(board)
+    for move, score in copy(board).items():
+        assert score == pytest.approx(expected[move], abs=1e-6)
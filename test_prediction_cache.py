@@ -0,0 +1,40 @@
+import chess
+
+from prediction_cache import CachedPredictor, cache_session
+
+
+def uniform_predictor(board: chess.Board) -> dict[chess.Move, float]:
+    return {move: 0.5 for move in board.legal_moves}
+
+
+def test_hits_evicted_by_the_same_batch():
+    cache = CachedPredictor(uniform_predictor, max_entries=1)
+    a = chess.Board()
+    b = chess.Board()
+    b.push_uci("e2e4")
+    cache(a)
+    predictions = cache.predict_many([a, b, a])
+    assert [len(prediction) for prediction in predictions] == [20, 20, 20]
+    assert cache.hits == 2 and cache.misses == 2
+    assert len(cache.entries) == 1
+
+
+def test_small_byte_budget():
+    cache = CachedPredictor(uniform_predictor, max_entries=None, max_bytes=1)
+    boards = [chess.Board(), chess.Board()]
+    boards[1].push_uci("d2d4")
+    assert cache.predict_many(boards) == [uniform_predictor(b) for b in boards]
+    assert cache.predict_many(boards[::-1]) == [
+        uniform_predictor(b) for b in boards[::-1]
+    ]
+
+
+def test_cache_session_saves_and_loads(tmp_path):
+    path = str(tmp_path / "cache.npz")
+    with cache_session(uniform_predictor) as predict:
+        assert predict is uniform_predictor
+    with cache_session(uniform_predictor, path=path) as predict:
+        predict(chess.Board())
+    with cache_session(uniform_predictor, path=path) as predict:
+        assert predict(chess.Board()) == uniform_predictor(chess.Board())
+        assert predict.hits == 1 and predict.misses == 0
@@ -0,0 +1,72 @@
+import chess
+import numpy as np
+
+from search_tree import SearchTree
+from to_matrix import code_to_move, move_to_code
+
+
+def hashed_predictor(board: chess.Board) -> dict[chess.Move, float]:
+    # Deterministic and uneven, so the tree grows deeper on some moves
+    return {move: (move_to_code(move) * 7919 % 101) / 101 for move in board.legal_moves}
+
+
+def grown_tree(nodes: int = 300) -> SearchTree:
+    tree = SearchTree(chess.Board(), hashed_predictor, chunk_size=64)
+    while tree.n_explored() < nodes and tree.expand_batch(4):
+        pass
+    return tree
+
+
+def subtree_snapshot(tree: SearchTree, node: int) -> dict[tuple, tuple]:
+    # (moves from the node) -> (value, leaves) for every node of the subtree
+    snapshot = {}
+    stack = [(node, ())]
+    while stack:
+        node, path = stack.pop()
+        snapshot[path] = (float(tree.value[node]), int(tree.n_leaves[node]))
+        for child in tree.children(node):
+            stack.append((child, path + (int(tree.move[child]),)))
+    return snapshot
+
+
+def check_links(tree: SearchTree):
+    for node in range(1, tree.size):
+        assert node in tree.children(int(tree.parent[node]))
+
+
+def test_advance_keeps_the_subtree():
+    tree = grown_tree()
+    board = chess.Board()
+    children = tree.children(0)
+    best = children[int(np.argmax(tree.n_leaves[children.start : children.stop]))]
+    grandchildren = tree.children(best)
+    reply = grandchildren[
+        int(np.argmax(tree.n_leaves[grandchildren.start : grandchildren.stop]))
+    ]
+    expected = subtree_snapshot(tree, reply)
+    for node in (best, reply):
+        board.push(code_to_move(int(tree.move[node])))
+    assert tree.advance(board)
+    assert tree.board == board
+    assert subtree_snapshot(tree, 0) == expected
+    check_links(tree)
+    explored = tree.n_explored()
+    while tree.n_explored() < explored + 100 and tree.expand_batch(4):
+        pass
+    check_links(tree)
+    assert set(tree.root_values()) == set(board.legal_moves)
+
+
+def test_advance_refuses_other_positions():
+    # Only the root is expanded, its children have no children yet
+    tree = SearchTree(chess.Board(), hashed_predictor)
+    tree.expand()
+    board = chess.Board()
+    board.push_uci("e2e4")
+    board.push_uci("e7e5")
+    assert not tree.advance(board)
+    assert not tree.advance(chess.Board("8/8/8/8/8/2k5/8/4K3 w - - 0 1"))
+    assert tree.advance(chess.Board())
+    board.pop()
+    assert tree.advance(board)
+    assert tree.board == board and not tree.n_children[0]
@@ -0,0 +1,28 @@
+import io
+
+import chess
+
+from uci import UciEngine
+
+
+def engine_lines(commands: list[str]) -> list[str]:
+    output = io.StringIO()
+    engine = UciEngine(None, nodes=20, output=output)
+    for command in commands:
+        engine.handle(command)
+    engine.thread.join()
+    return output.getvalue().splitlines()
+
+
+def test_node_limit_with_movetime():
+    engine = UciEngine(None, output=io.StringIO())
+    deadline, nodes, _margin = engine.search_bounds(
+        chess.Board(), {"movetime": 60000, "nodes": 30}
+    )
+    assert deadline is not None and nodes == 30
+
+
+def test_bestmove_is_the_last_line():
+    lines = engine_lines(["position startpos moves e2e4", "go movetime 1500"])
+    assert lines[-1].startswith("bestmove ")
+    assert all(not line.startswith("bestmove") for line in lines[:-1])
@@ -13,25 +13,173 @@ class Strategy:
     rating: float
 
 
+PIECES = ["P", "N", "B", "R", "Q", "K"]
+CASTLING_SQUARES = [chess.H1, chess.A1, chess.H8, chess.A8]
+# 12 piece planes, side to move, 4 castling rights and the en passant square
+POLICY_PLANES = len(PIECES) * 2 + 6
+# Every from/to pair (queen promotions included), then the under-promotions
+# to a knight, bishop or rook by (piece, from file, to file)
+POLICY_SIZE = 64 * 64 + 3 * 8 * 8
+
+
+def board_bitboards(board: chess.Board) -> np.ndarray:
+    # One bitboard per (color, piece) pair, black pieces first
+    return np.array(
+        [
+            board.pieces_mask(piece_type, color)
+            for color in (chess.BLACK, chess.WHITE)
+            for piece_type in chess.PIECE_TYPES
+        ],
+        dtype="<u8",
+    )
+
+
+def bitboards_to_planes(bitboards: np.ndarray) -> np.ndarray:
+    # Bit `square` of every bitboard lands on [square // 8, square % 8]
+    bitboards = np.ascontiguousarray(bitboards, dtype="<u8")
+    return np.unpackbits(
+        bitboards.view(np.uint8).reshape(*bitboards.shape, 8),
+        axis=-1,
+        bitorder="little",
+    ).reshape(*bitboards.shape, 8, 8)
+
+
+def board_to_planes(board: chess.Board) -> np.ndarray:
+    return bitboards_to_planes(board_bitboards(board))
+
+
+def pack_castling(board: chess.Board) -> int:
+    return sum(
+        1 << i
+        for i, square in enumerate(CASTLING_SQUARES)
+        if board.castling_rights & chess.BB_SQUARES[square]
+    )
+
+
+def positions_to_policy_planes(
+    bitboards: np.ndarray,
+    turn: np.ndarray,
+    castling: np.ndarray,
+    ep_square: np.ndarray,
+) -> np.ndarray:
+    # Vectorized over positions stored like binary_dataset.POSITION_DTYPE
+    n_positions = len(bitboards)
+    planes = np.zeros((n_positions, POLICY_PLANES, 64), dtype=np.float32)
+    planes[:, : len(PIECES) * 2] = bitboards_to_planes(bitboards).reshape(
+        n_positions, -1, 64
+    )
+    planes[:, -6] = np.asarray(turn)[:, None]
+    planes[:, -5:-1] = (np.asarray(castling)[:, None] >> np.arange(4) & 1)[..., None]
+    ep_square = np.asarray(ep_square)
+    rows = np.flatnonzero(ep_square >= 0)
+    planes[rows, -1, ep_square[rows]] = 1
+    return planes.reshape(n_positions, POLICY_PLANES, 8, 8)
+
+
+def boards_to_policy_planes(boards: list[chess.Board]) -> np.ndarray:
+    return positions_to_policy_planes(
+        np.array([board_bitboards(board) for board in boards]).reshape(-1, 12),
+        np.array([board.turn for board in boards]),
+        np.array([pack_castling(board) for board in boards]),
+        np.array([-1 if b.ep_square is None else b.ep_square for b in boards]),
+    )
+
+
+def board_and_moves_to_matrix(
+    board: chess.Board, moves: list[chess.Move] | None = None
+) -> np.ndarray:
+    if moves is None:
+        moves = list(board.legal_moves)
+    n_moves = len(moves)
+    matrix = np.zeros((n_moves, len(PIECES) * 2 + 2, 64), dtype=np.float32)
+    matrix[:, : len(PIECES) * 2] = board_to_planes(board).reshape(-1, 64)
+    rows = np.arange(n_moves)
+    from_squares = np.fromiter(
+        (move.from_square for move in moves), dtype=np.intp, count=n_moves
+    )
+    to_squares = np.fromiter(
+        (move.to_square for move in moves), dtype=np.intp, count=n_moves
+    )
+    matrix[rows, -1, from_squares] = 1
+    matrix[rows, -2, to_squares] = 1
+    return matrix.reshape(n_moves, len(PIECES) * 2 + 2, 8, 8)
+
+
 def board_and_move_to_matrix(board: chess.Board, move: chess.Move) -> np.ndarray:
-    pieces = [
-        "P",
-        "N",
-        "B",
-        "R",
-        "Q",
-        "K",
-    ]
-    matrix = np.zeros((len(pieces) * 2 + 2, 8, 8), dtype=int)
-    for square, piece in board.piece_map().items():
-        matrix[
-            (len(pieces) if piece.color else 0) + pieces.index(piece.symbol().upper()),
-            square // 8,
-            square % 8,
-        ] = 1
-    matrix[-1, move.from_square // 8, move.from_square % 8] = 1
-    matrix[-2, move.to_square // 8, move.to_square % 8] = 1
-    return matrix
+    return board_and_moves_to_matrix(board, [move])[0].astype(int)
+
+
+def move_to_code(move: chess.Move) -> int:
+    # from | to << 6 | promotion << 12, fits in an uint16
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def code_to_move(code: int) -> chess.Move:
+    return chess.Move(code & 63, code >> 6 & 63, promotion=(code >> 12) or None)
+
+
+# Everything a FEN with en_passant="fen" holds: the piece and color
+# bitboards, turn, castling rights, en passant square, halfmove clock and
+# fullmove number
+PositionKey = tuple[int, ...]
+
+
+def position_key(board: chess.Board) -> PositionKey:
+    return (
+        board.pawns,
+        board.knights,
+        board.bishops,
+        board.rooks,
+        board.queens,
+        board.kings,
+        board.occupied_co[chess.WHITE],
+        board.occupied_co[chess.BLACK],
+        board.turn,
+        board.castling_rights,
+        -1 if board.ep_square is None else board.ep_square,
+        board.halfmove_clock,
+        board.fullmove_number,
+    )
+
+
+def key_board(key: PositionKey) -> chess.Board:
+    board = chess.Board.empty()
+    (
+        board.pawns,
+        board.knights,
+        board.bishops,
+        board.rooks,
+        board.queens,
+        board.kings,
+        white,
+        black,
+        board.turn,
+        board.castling_rights,
+        ep_square,
+        board.halfmove_clock,
+        board.fullmove_number,
+    ) = key
+    board.occupied_co[chess.WHITE] = white
+    board.occupied_co[chess.BLACK] = black
+    board.occupied = white | black
+    board.ep_square = None if ep_square < 0 else ep_square
+    return board
+
+
+def codes_to_policy_indices(codes: np.ndarray) -> np.ndarray:
+    # Index of each move code in the POLICY_SIZE outputs of a PolicyNetwork
+    codes = np.asarray(codes, dtype=np.int64)
+    from_squares = codes & 63
+    to_squares = codes >> 6 & 63
+    promotions = codes >> 12
+    under_promotion = (promotions >= chess.KNIGHT) & (promotions <= chess.ROOK)
+    return np.where(
+        under_promotion,
+        64 * 64
+        + ((promotions - chess.KNIGHT) * 8 + (from_squares & 7)) * 8
+        + (to_squares & 7),
+        from_squares * 64 + to_squares,
+    )
 
 
 def strategies_from_fen(fen: str, moves: list[str]) -> list[Strategy]:
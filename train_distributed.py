@@ -0,0 +1,111 @@
+import os
+import time
+
+import click
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from network import Network, StrategyBatches, strategy_loader
+
+
+def train_worker(
+    rank: int,
+    world_size: int,
+    prefix: str,
+    batch_size: int,
+    epochs: int,
+    checkpoint_interval: int,
+    loader_workers: int,
+    checkpoint_prefix: str,
+    port: int,
+):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(max((os.cpu_count() or 1) // world_size, 1))
+
+    # Every rank reads a disjoint part of each shuffled shard
+    dataset = StrategyBatches(prefix, batch_size, part=rank, n_parts=world_size)
+    loader = strategy_loader(dataset, loader_workers)
+    network = Network()
+    model = DistributedDataParallel(network)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    loss_function = torch.nn.MSELoss()
+    if rank == 0:
+        print(f"Num params: {sum(p.numel() for p in network.parameters())}")
+
+    for epoch in range(epochs):
+        dataset.epoch = epoch
+        loss_sum = 0.0
+        n_batches = 0
+        n_samples = 0
+        start = time.perf_counter()
+        # Ranks can end up with a different number of batches
+        with model.join():
+            for board_and_moves, ratings in loader:
+                optimizer.zero_grad()
+                loss = loss_function(model(board_and_moves), ratings)
+                loss.backward()
+                optimizer.step()
+                loss_sum += loss.item()
+                n_batches += 1
+                n_samples += len(ratings)
+        elapsed = time.perf_counter() - start
+
+        totals = torch.tensor([loss_sum, n_batches], dtype=torch.float64)
+        dist.all_reduce(totals)
+        throughputs: list[float] = [0.0] * world_size
+        dist.all_gather_object(throughputs, n_samples / elapsed)
+        if rank == 0:
+            print(
+                f"Loss: {totals[0].item() / max(totals[1].item(), 1)} after epoch {epoch};",
+                f"samples/sec per rank: {', '.join(f'{t:.0f}' for t in throughputs)};",
+                f"aggregate: {sum(throughputs):.0f}",
+            )
+            if not epoch % checkpoint_interval:
+                # The unwrapped state dict, so Predictor can load it as usual
+                torch.save(
+                    network.state_dict(), f"{checkpoint_prefix}_epoch_{epoch}.pt"
+                )
+
+    dist.destroy_process_group()
+
+
+@click.command()
+@click.option("--data", default="fens", help="Prefix of the binary dataset shards")
+@click.option("--processes", default=4)
+@click.option("--batch-size", default=256, help="Positions per mini-batch and rank")
+@click.option("--epochs", default=1000)
+@click.option("--checkpoint-interval", default=100)
+@click.option("--loader-workers", default=1)
+@click.option("--checkpoint-prefix", default="network_ddp")
+@click.option("--port", default=29500)
+def main(
+    data: str,
+    processes: int,
+    batch_size: int,
+    epochs: int,
+    checkpoint_interval: int,
+    loader_workers: int,
+    checkpoint_prefix: str,
+    port: int,
+):
+    torch.multiprocessing.spawn(
+        train_worker,
+        args=(
+            processes,
+            data,
+            batch_size,
+            epochs,
+            checkpoint_interval,
+            loader_workers,
+            checkpoint_prefix,
+            port,
+        ),
+        nprocs=processes,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+import math
+import sys
+import threading
+import time
+from typing import IO
+
+import chess
+import click
+import torch
+
+from amplify import Searcher, time_budget
+from predict import Predictor
+from prediction_cache import CachedPredictor
+
+INFO_INTERVAL = 1.0
+
+
+def score_cp(value: float) -> int:
+    # Root values are in [0, 1] for the side to move, shown as a logistic
+    # centipawn score
+    value = min(max(value, 0.001), 0.999)
+    return round(400 * math.log10(value / (1 - value)))
+
+
+def parse_go(tokens: list[str]) -> dict[str, int | bool]:
+    limits: dict[str, int | bool] = {}
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in ("infinite", "ponder"):
+            limits[tokens[i]] = True
+        elif i + 1 < len(tokens) and tokens[i + 1].lstrip("-").isdigit():
+            limits[tokens[i]] = int(tokens[i + 1])
+            i += 1
+        i += 1
+    return limits
+
+
+class UciEngine:
+    # Keeps the model and the search tree loaded between moves. Searches run
+    # on a background thread so "stop" and "ponderhit" are read while they
+    # go on; positions that follow from the previous one reuse its subtree.
+    def __init__(
+        self,
+        checkpoint: str | None,
+        nodes: int = 1000,
+        batch_size: int = 1,
+        threads: int | None = None,
+        output: IO = sys.stdout,
+        cache: bool = False,
+        cache_file: str | None = None,
+    ):
+        self.checkpoint = checkpoint
+        self.default_nodes = nodes
+        self.threads = threads
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.cache = cache or cache_file is not None
+        self.cache_file = cache_file
+        self.predictor = self.load_predictor()
+        self.searcher = Searcher(self.predictor, nodes, batch_size, collect_stats=True)
+        self.board = chess.Board()
+        self.thread: threading.Thread | None = None
+        # One per search, so a late "stop" can't end the next one
+        self.stopped = threading.Event()
+        self.limits: dict[str, int | bool] = {}
+        # Set by ponderhit, the ponder search then ends without a bestmove
+        self.ponder_hit = False
+
+    def send(self, line: str):
+        with self.output_lock:
+            print(line, file=self.output, flush=True)
+
+    def handle(self, line: str) -> bool:
+        # Returns False on "quit"
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, arguments = tokens[0], tokens[1:]
+        if command == "uci":
+            self.send("id name chess-ai-experiment")
+            self.send("id author chess-ai-experiment")
+            self.send("option name Ponder type check default false")
+            self.send(
+                f"option name Nodes type spin default {self.default_nodes}"
+                " min 1 max 100000000"
+            )
+            self.send(
+                f"option name BatchSize type spin default {self.searcher.batch_size}"
+                " min 1 max 1024"
+            )
+            self.send(
+                f"option name Threads type spin default {torch.get_num_threads()}"
+                " min 1 max 256"
+            )
+            self.send(f"option name Checkpoint type string default {self.checkpoint}")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "setoption":
+            self.set_option(arguments)
+        elif command == "ucinewgame":
+            self.stop()
+            self.searcher.reset()
+            self.board = chess.Board()
+        elif command == "position":
+            self.stop()
+            self.board = self.parse_position(arguments)
+        elif command == "go":
+            self.stop()
+            self.go(parse_go(arguments))
+        elif command == "stop":
+            self.stop()
+        elif command == "ponderhit":
+            self.ponderhit()
+        elif command == "quit":
+            self.stop()
+            return False
+        return True
+
+    def load_predictor(self) -> Predictor | CachedPredictor:
+        predictor = Predictor(self.checkpoint, threads=self.threads)
+        if not self.cache:
+            return predictor
+        return CachedPredictor(predictor, path=self.cache_file)
+
+    def save_cache(self):
+        if isinstance(self.predictor, CachedPredictor) and self.cache_file:
+            self.predictor.save(self.cache_file)
+
+    def set_option(self, arguments: list[str]):
+        if "name" not in arguments:
+            return
+        name_end = arguments.index("value") if "value" in arguments else None
+        name = " ".join(arguments[arguments.index("name") + 1 : name_end]).lower()
+        value = " ".join(arguments[name_end + 1 :]) if name_end is not None else ""
+        self.stop()
+        if name == "nodes":
+            self.default_nodes = int(value)
+        elif name == "batchsize":
+            self.searcher.batch_size = int(value)
+        elif name == "threads":
+            self.threads = int(value)
+            torch.set_num_threads(self.threads)
+        elif name == "checkpoint":
+            # The cache file holds the old checkpoint's predictions, it is
+            # saved and the new checkpoint gets an empty in-memory cache
+            self.save_cache()
+            self.cache_file = None
+            self.checkpoint = value or None
+            self.predictor = self.load_predictor()
+            self.searcher.predict = self.predictor
+            self.searcher.reset()
+
+    def parse_position(self, arguments: list[str]) -> chess.Board:
+        moves_at = arguments.index("moves") if "moves" in arguments else len(arguments)
+        if arguments and arguments[0] == "fen":
+            board = chess.Board(" ".join(arguments[1:moves_at]))
+        else:
+            board = chess.Board()
+        for uci in arguments[moves_at + 1 :]:
+            board.push_uci(uci)
+        return board
+
+    def go(self, limits: dict[str, int | bool]):
+        self.limits = limits
+        self.ponder_hit = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.search, args=(self.board.copy(), limits), daemon=True
+        )
+        self.thread.start()
+
+    def search_bounds(
+        self, board: chess.Board, limits: dict[str, int | bool]
+    ) -> tuple[float | None, int | None, float | None]:
+        # (deadline, nodes, dominance margin) of a search, a node limit is
+        # kept next to a time limit and the search ends on the first one
+        if limits.get("infinite") or limits.get("ponder"):
+            return None, None, None
+        if "movetime" in limits:
+            return (
+                time.monotonic() + limits["movetime"] / 1000,
+                limits.get("nodes"),
+                None,
+            )
+        side = "w" if board.turn == chess.WHITE else "b"
+        if f"{side}time" in limits:
+            budget = time_budget(
+                limits[f"{side}time"] / 1000,
+                limits.get(f"{side}inc", 0) / 1000,
+                limits.get("movestogo"),
+            )
+            return (
+                time.monotonic() + budget,
+                limits.get("nodes"),
+                self.searcher.dominance_margin,
+            )
+        return None, limits.get("nodes", self.default_nodes), None
+
+    def search(self, board: chess.Board, limits: dict[str, int | bool]):
+        deadline, nodes, dominance_margin = self.search_bounds(board, limits)
+        # The reporter is done before the final info and bestmove are sent
+        searched = threading.Event()
+        reporter = threading.Thread(target=self.report, args=(searched,), daemon=True)
+        reporter.start()
+        try:
+            values = self.searcher.search(
+                board,
+                deadline=deadline,
+                nodes=nodes,
+                dominance_margin=dominance_margin,
+                stopped=self.stopped,
+            )
+        finally:
+            searched.set()
+            reporter.join()
+        if self.ponder_hit:
+            return
+        stats = self.searcher.stats
+        pv = stats.principal_variation
+        if values:
+            best = max(values, key=values.get)
+            self.send(
+                f"info depth {len(pv)} seldepth {stats.max_depth}"
+                f" score cp {score_cp(values[best])} nodes {stats.explored}"
+                f" nps {round(stats.explored / stats.seconds) if stats.seconds else 0}"
+                f" time {round(stats.seconds * 1000)} pv {' '.join(pv)}"
+            )
+            ponder = f" ponder {pv[1]}" if len(pv) > 1 and pv[0] == best.uci() else ""
+            self.send(f"bestmove {best.uci()}{ponder}")
+        else:
+            self.send("bestmove 0000")
+
+    def report(self, searched: threading.Event):
+        # Progress of a long search, from the stats the tree fills in. Nodes
+        # are explored leaves, the quantity "go nodes" limits.
+        start = time.monotonic()
+        while not searched.wait(INFO_INTERVAL):
+            tree = self.searcher.tree
+            stats = None if tree is None else tree.stats
+            if stats is None:
+                continue
+            elapsed = time.monotonic() - start
+            self.send(
+                f"info nodes {stats.explored} nps {round(stats.explored / elapsed)}"
+                f" time {round(elapsed * 1000)}"
+            )
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+        self.thread = None
+
+    def ponderhit(self):
+        # The expected move was played: the ponder search ends quietly and a
+        # timed search continues on the same tree
+        if not self.limits.get("ponder"):
+            return
+        self.ponder_hit = True
+        self.stop()
+        limits = dict(self.limits)
+        del limits["ponder"]
+        self.go(limits)
+
+
+@click.command()
+@click.option("--checkpoint", default="network_9.pt")
+@click.option("--nodes", default=1000, help="Nodes per move without a time limit")
+@click.option("--batch-size", default=1)
+@click.option("--threads", default=None, type=int)
+@click.option("--cache", is_flag=True, help="Cache the evaluations of positions")
+@click.option(
+    "--cache-file",
+    default=None,
+    help="Load the cache from and save it to this file on quit",
+)
+def main(
+    checkpoint: str,
+    nodes: int,
+    batch_size: int,
+    threads: int | None,
+    cache: bool,
+    cache_file: str | None,
+):
+    engine = UciEngine(
+        checkpoint, nodes, batch_size, threads, cache=cache, cache_file=cache_file
+    )
+    try:
+        for line in sys.stdin:
+            if not engine.handle(line):
+                break
+    finally:
+        engine.stop()
+        engine.save_cache()
+
+
+if __name__ == "__main__":
+    main()